@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the data processing done by the Facebook research application.
+
+The benchmarks run on synthetic Graph API data, so they do not need network
+access or an access token. Run a benchmark by name, e.g.::
+
+    python benchmark.py post_memory
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import calendar
+import datetime
+
+import facebook
+
+
+def make_graph_posts(n, users=200, seed=0):
+    """
+    Generate wall posts shaped like the ones returned by the Graph API.
+
+    The posts are passed through the JSON decoder so that their strings are
+    separate objects, as they would be after a real request.
+
+    @param n: The number of posts to generate
+    @type  n: C{int}
+    @param users: The number of distinct users that write, like, and comment
+    @type  users: C{int}
+    @param seed: Seed for the random generator
+    @type  seed: C{int}
+    @return: The posts
+    @rtype: C{list} of C{dict}
+    """
+    rand = random.Random(seed)
+    start = datetime.datetime(2011, 1, 1)
+    people = [{'id': str(100000000000000 + i), 'name': "User {0}".format(i)} for i in range(users)]
+    posts = []
+    for i in range(n):
+        author = rand.choice(people)
+        created = start + datetime.timedelta(seconds=rand.randint(0, 365 * 86400))
+        post = {'id': "{0}_{1}".format(author['id'], i), 'from': author,
+                'created_time': created.strftime("%Y-%m-%dT%H:%M:%S") + "+0000",
+                'message': " ".join(["word"] * rand.randint(0, 40))}
+        likers = rand.sample(people, rand.randint(0, 5))
+        if likers:
+            post['likes'] = {'data': likers, 'count': len(likers)}
+        commenters = [rand.choice(people) for j in range(rand.randint(0, 4))]
+        if commenters:
+            post['comments'] = {'data': [{'id': "{0}_{1}".format(post['id'], j), 'from': commenter, 'message': "comment"}
+                                         for j, commenter in enumerate(commenters)], 'count': len(commenters)}
+        posts.append(post)
+    return json.loads(json.dumps(posts))
+
+
+def deep_size(obj, seen=None):
+    """
+    Get the memory used by an object and everything it refers to.
+
+    Objects shared between several containers, such as interned strings, are
+    only counted once.
+
+    @param obj: The object to measure
+    @type  obj: mixed
+    @return: The size in bytes
+    @rtype: C{int}
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+def dict_post(post):
+    """
+    Convert a Graph API post the way User did before posts were made compact.
+
+    @param post: A post from the Graph API
+    @type  post: C{dict}
+    @return: The post as a dict
+    @rtype: C{dict}
+    """
+    post = dict([(key, value) for key, value in post.iteritems() if key in facebook.User.import_fields])
+    post['created_time'] = datetime.datetime.strptime(post['created_time'][:-5], "%Y-%m-%dT%H:%M:%S")
+    post['to'] = {'name': "User", 'id': "100000000000000"}
+    post['likes'] = post.get('likes', {'data': []})
+    post['comments'] = post.get('comments', {'data': []})
+    return post
+
+
+def post_memory(n=20000):
+    """
+    Compare the memory used per wall post by dicts and by L{facebook.Post}.
+
+    @param n: The number of posts to measure
+    @type  n: C{int}
+    """
+    dicts = [dict_post(post) for post in make_graph_posts(n)]
+    posts = [facebook.Post.from_graph(post) for post in make_graph_posts(n)]
+    before = deep_size(dicts) / float(n)
+    after = deep_size(posts) / float(n)
+    print "Wall posts: {0}".format(n)
+    print "dict posts: {0:.0f} bytes per post".format(before)
+    print "Post objects: {0:.0f} bytes per post".format(after)
+    print "Reduction: {0:.1f}x".format(before / after)
+
+
+def strptime_time(value):
+    """
+    Convert a Graph API timestamp the way User did before graph_time existed.
+
+    @param value: A timestamp such as C{"2011-06-09T19:38:21+0000"}
+    @type  value: C{str}
+    @return: The time in seconds since the epoch
+    @rtype: C{int}
+    """
+    return calendar.timegm(datetime.datetime.strptime(value[:-5], "%Y-%m-%dT%H:%M:%S").utctimetuple())
+
+
+def timestamp_parsing(n=1000000):
+    """
+    Compare parsing Graph API timestamps with strptime and with L{facebook.graph_time}.
+
+    @param n: The number of timestamps to parse
+    @type  n: C{int}
+    """
+    rand = random.Random(0)
+    start = datetime.datetime(2008, 1, 1)
+    timestamps = [(start + datetime.timedelta(seconds=rand.randint(0, 4 * 365 * 86400))).strftime("%Y-%m-%dT%H:%M:%S") + "+0000"
+                  for i in xrange(n)]
+    begin = time.time()
+    before = [strptime_time(value) for value in timestamps]
+    strptime_seconds = time.time() - begin
+    begin = time.time()
+    after = [facebook.graph_time(value) for value in timestamps]
+    graph_time_seconds = time.time() - begin
+    assert before == after
+    print "Timestamps: {0}".format(n)
+    print "strptime: {0:.2f}s ({1:.2f}us each)".format(strptime_seconds, strptime_seconds / n * 1e6)
+    print "graph_time: {0:.2f}s ({1:.2f}us each)".format(graph_time_seconds, graph_time_seconds / n * 1e6)
+    print "Speedup: {0:.1f}x".format(strptime_seconds / graph_time_seconds)
+
+
+def make_user(users=200, posts=100, likes=50, seed=0):
+    """
+    Build a user whose friends have synthetic walls and likes, without network access.
+
+    Every user is created lazily and has its attributes filled in directly,
+    and the friends are put in L{facebook.User.registry}, so nothing is ever
+    fetched from the Graph API.
+
+    @param users: The number of users, including the user returned
+    @type  users: C{int}
+    @param posts: The number of posts on each wall
+    @type  posts: C{int}
+    @param likes: The number of pages each user likes
+    @type  likes: C{int}
+    @param seed: Seed for the random generator
+    @type  seed: C{int}
+    @return: The first user, with the others as friends
+    @rtype: L{facebook.User}
+    """
+    logger = logging.getLogger('facebook-research')
+    graph = facebook.GraphAPI(logger, json.loads, 'benchmark', json_dump=json.dumps)
+    rand = random.Random(seed)
+    people = []
+    for i in range(users):
+        user_id = str(100000000000000 + i)
+        user = facebook.User(graph, logger, user_id, 0, lazy=True)
+        user.me = user.identity = {'id': user_id, 'name': "User {0}".format(i)}
+        wall = make_graph_posts(posts, users, seed + i + 1)
+        for post in wall[::2]:
+            post['from'] = user.identity
+        user.wall = [facebook.Post.from_graph(post) for post in wall]
+        user.likes = frozenset(rand.sample(xrange(20 * likes), likes))
+        user.friends = []
+        people.append(user)
+    for user in people[1:]:
+        facebook.User.registry.add(user, user.identity['id'])
+    people[0].friends = people[1:]
+    return people[0]
+
+
+def post_features(user, post, window=3 * 86400):
+    """
+    Gather the data for one post the way User did before L{facebook.FeatureEngine} existed.
+
+    Both walls are filtered again for every post, instead of once per author.
+
+    @param user: The user the post is being evaluated for
+    @type  user: L{facebook.User}
+    @param post: The post
+    @type  post: L{facebook.Post}
+    @param window: How far back, in seconds, interactions are counted
+    @type  window: C{int}
+    @return: Whether the post is important and a tuple of parameters
+    @rtype: C{tuple} with C{int} and C{tuple}
+    """
+    if post.author == user.identity['id']:
+        author = user
+    else:
+        options = user.options
+        author = user.registry.get(user.graph, user.logger, post.author, batch=options['batch'],
+                                   max_posts=options['max_posts'], columnar=options['columnar'])
+    if author is not user:
+        before = post.created_time
+        talked = (user.wall_filter(time_end=before, author=author, commented_by=author, intersect=False) +
+                  author.wall_filter(time_end=before, author=user, commented_by=user, intersect=False))
+        time_diff = before - max([other.created_time for other in talked] or [0])
+    else:
+        time_diff = 0
+    start = post.created_time - window
+    me2you = (len(author.wall_filter(time_start=start, time_end=post.created_time, author=author, liked_by=user)) +
+              len(author.wall_filter(time_start=start, time_end=post.created_time, author=author, commented_by=user)))
+    you2me = (len(user.wall_filter(time_start=start, time_end=post.created_time, author=user, liked_by=author)) +
+              len(user.wall_filter(time_start=start, time_end=post.created_time, author=user, commented_by=author)))
+    return int(user.is_important(post)), (post.size, float(time_diff), me2you, you2me, len(user.likes & author.likes))
+
+
+def feature_extraction(n=1000):
+    """
+    Compare gathering training data with L{facebook.FeatureEngine} and one post at a time.
+
+    The wall indexes are built before timing, so both paths only pay for
+    the filtering and counting.
+
+    @param n: The number of posts to sample
+    @type  n: C{int}
+    """
+    user = make_user()
+    posts = user.wall_sample(n, seed=0)
+    for person in [user] + user.friends:
+        person.wall_index()
+    begin = time.time()
+    before = [post_features(user, post) for post in posts]
+    per_post_seconds = time.time() - begin
+    begin = time.time()
+    after = facebook.FeatureEngine(user).features(posts)
+    engine_seconds = time.time() - begin
+    assert before == after
+    print "Posts: {0} by {1} authors".format(len(posts), len(set(post.author for post in posts)))
+    print "One post at a time: {0:.1f}ms".format(per_post_seconds * 1e3)
+    print "FeatureEngine: {0:.1f}ms".format(engine_seconds * 1e3)
+    print "Speedup: {0:.1f}x".format(per_post_seconds / engine_seconds)
+
+
+def scoring_latency(batch_size=100, batches=50):
+    """
+    Measure the latency of scoring batches of new posts with L{svm.score_posts}.
+
+    The first batch builds the user's wall indexes and interaction timelines;
+    later batches reuse them. Scoring the same posts one at a time is timed
+    for comparison. Needs NumPy, unlike the other benchmarks.
+
+    @param batch_size: The number of posts in each batch
+    @type  batch_size: C{int}
+    @param batches: The number of batches to time after the first
+    @type  batches: C{int}
+    """
+    import numpy
+    import svm
+    data = make_user().make_training_data(1000, seed=0)
+    features = numpy.array([row for important, row in data])
+    labels = numpy.array([1.0 if important else -1.0 for important, row in data])
+    print "Batch size: {0}".format(batch_size)
+    for name, (model, report) in (('linear', svm.train(features, labels)), ('rbf', svm.train_kernel(features, labels))):
+        user = make_user()
+        posts = [make_graph_posts(batch_size, seed=1000 + i) for i in range(batches + 1)]
+        begin = time.time()
+        svm.score_posts(user, posts[0], model)
+        first = time.time() - begin
+        latencies = []
+        for batch in posts[1:]:
+            begin = time.time()
+            svm.score_posts(user, batch, model)
+            latencies.append(time.time() - begin)
+        latencies.sort()
+        begin = time.time()
+        for post in posts[-1]:
+            svm.score_posts(user, [post], model)
+        single = time.time() - begin
+        median = latencies[len(latencies) // 2]
+        print "{0} model: first batch {1:.1f}ms, then median {2:.2f}ms and p95 {3:.2f}ms per batch ({4:.1f}us per post)".format(
+            name, first * 1e3, median * 1e3, latencies[int(len(latencies) * 0.95)] * 1e3, median / batch_size * 1e6)
+        print "{0} model: one post at a time {1:.2f}ms for the same batch ({2:.1f}x slower)".format(
+            name, single * 1e3, single / median)
+
+
+BENCHMARKS = {'post_memory': post_memory, 'timestamp_parsing': timestamp_parsing, 'feature_extraction': feature_extraction,
+              'scoring_latency': scoring_latency}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print "Usage: python benchmark.py <{0}>".format("|".join(sorted(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]]()
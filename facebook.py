@@ -28,136 +28,1759 @@ Graph API. Read more about the Graph API at http://developers.facebook.com/docs/
 """
 
 import urllib
+import urlparse
+import httplib
+import calendar
 import datetime
 import random
-import operator
+import threading
+import time
+import collections
+import itertools
+import bisect
+import hashlib
+import os
+import socket
+import errno
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Find a JSON parser, fastest first. django.utils.simplejson is for Google AppEngine.
+JSON_PARSERS = 'ujson', 'simplejson', 'json', 'django.utils.simplejson'
+JSON_SERIALIZERS = 'simplejson', 'json', 'django.utils.simplejson'
 
-# Find a JSON parser
 def find_json(logger, parser=True):
     logger.debug("Searching for JSON parser...")
-    try:
-        import json
+    for name in JSON_PARSERS if parser else JSON_SERIALIZERS:
+        try:
+            module = __import__(name, fromlist=['loads'])
+        except ImportError:
+            continue
+        logger.debug("Using {0} for JSON.".format(name))
         if parser:
-            _parse_json = lambda s: json.loads(s)
+            return module.loads
         else:
-            _parse_json = lambda s: json.dumps(s)
+            return module.dumps
+    logger.critical("JSON parser not found.")
+    raise ImportError("No JSON parser found.")
+
+def find_json_load(logger):
+    """
+    Get a function that parses JSON read from a file, from the same libraries as find_json.
+    
+    @return: The load function of the fastest JSON library available
+    @rtype: C{function}
+    """
+    for name in JSON_PARSERS:
+        try:
+            module = __import__(name, fromlist=['load'])
+        except ImportError:
+            continue
+        logger.debug("Using {0} for JSON responses.".format(name))
+        return module.load
+    logger.critical("JSON parser not found.")
+    raise ImportError("No JSON parser found.")
+
+# Find an incremental JSON parser
+def find_stream_json(logger):
+    """
+    Get a function that parses a Graph API page incrementally from a file.
+    
+    The returned function yields C{('item', post)} for each element of the
+    page's data array as soon as it has been read, C{('next', url)} for the
+    paging cursor, and C{('error', error)} if Facebook returned an error.
+    
+    @return: The page parser, or None if ijson is not installed
+    @rtype: C{function}
+    """
+    try:
+        import ijson
     except ImportError:
+        logger.debug("ijson not found; streaming JSON parsing is disabled.")
+        return None
+    kinds = {'data.item': 'item', 'error': 'error'}
+    
+    def _parse_page(fp):
+        builder = None
+        root = None
+        for prefix, event, value in ijson.parse(fp):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == root and event in ('end_map', 'end_array'):
+                    yield kinds[root], builder.value
+                    builder = None
+            elif prefix in kinds:
+                if event in ('start_map', 'start_array'):
+                    root = prefix
+                    builder = ijson.common.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    yield kinds[prefix], value
+            elif prefix == 'paging.next':
+                yield 'next', value
+    return _parse_page
+
+
+def field_projection(fields, subfields=None):
+    """
+    Build a value for the Graph API fields parameter.
+    
+    Fields that have an entry in subfields are expanded into their own
+    projection, recursively, so nested objects only carry the keys we use.
+    
+    @param fields: The fields to request
+    @type  fields: C{tuple} of C{str}
+    @param subfields: The fields to request inside each nested object
+    @type  subfields: C{dict}
+    @return: The projection, e.g. C{"id,from{id,name}"}
+    @rtype: C{str}
+    """
+    subfields = subfields or {}
+    projection = []
+    for field in fields:
+        if field in subfields:
+            projection.append(field + "{" + field_projection(subfields[field], subfields) + "}")
+        else:
+            projection.append(field)
+    return ",".join(projection)
+
+
+def intern_id(value):
+    """
+    Intern a Graph API ID so that every copy of it shares one string.
+    
+    @param value: The ID
+    @type  value: C{unicode} or C{str}
+    @return: The interned ID
+    @rtype: C{str}
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return intern(value)
+
+
+def intern_like(value):
+    """
+    Convert the ID of a liked page to a compact form for a set of likes.
+    
+    Numeric IDs become integers, which are smaller than strings and faster
+    to hash and compare. IDs that are not numeric are interned as strings.
+    No table of IDs is kept, so IDs are freed with the users that like them.
+    
+    @param value: The page ID
+    @type  value: C{unicode} or C{str}
+    @return: The compact ID
+    @rtype: C{int} or C{str}
+    """
+    return int(value) if value.isdigit() else intern_id(value)
+
+
+_day_seconds = {}
+
+def graph_time(value, as_datetime=False):
+    """
+    Convert a Graph API timestamp into seconds since the epoch.
+    
+    The fixed-width fields are sliced out directly instead of going through
+    strptime, and the start of each day is cached since many posts share a
+    date. The UTC offset (C{+0000}, C{-07:00}, or C{Z}) is applied, so the
+    result is always in UTC.
+    
+    @param value: A timestamp such as C{"2011-06-09T19:38:21+0000"}
+    @type  value: C{str}
+    @param as_datetime: Whether to return a naive UTC datetime instead of an integer
+    @type  as_datetime: C{bool}
+    @return: The time in seconds since the epoch
+    @rtype: C{int} or datetime.datetime
+    """
+    day = value[:10]
+    seconds = _day_seconds.get(day)
+    if seconds is None:
+        seconds = _day_seconds[day] = calendar.timegm((int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    seconds += int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+    zone = value[19:]
+    if zone and zone != '+0000' and zone != 'Z':
+        offset = zone[1:].replace(':', '')
+        offset = int(offset[:2]) * 3600 + int(offset[2:4]) * 60
+        seconds += offset if zone[0] == '-' else -offset
+    if as_datetime:
+        return datetime.datetime.utcfromtimestamp(seconds)
+    return seconds
+
+
+def to_epoch(value):
+    """
+    Convert a datetime into seconds since the epoch, leaving numbers as they are.
+    
+    @param value: The time to convert
+    @type  value: datetime.datetime or C{int}
+    @return: The time in seconds since the epoch
+    @rtype: C{int}
+    """
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def reservoir_sample(items, n, rand=random):
+    """
+    Take a uniform random sample of up to n items from a stream in a single pass.
+    
+    Only the sample itself is kept in memory, so items can be a generator
+    over data that would not fit. If the stream has fewer than n items, all
+    of them are returned.
+    
+    @param items: The items to sample from
+    @type  items: iterable
+    @param n: The size of the sample
+    @type  n: C{int}
+    @param rand: The random number generator to use
+    @type  rand: C{random.Random}
+    @return: The sample
+    @rtype: C{list}
+    """
+    sample = []
+    for i, item in enumerate(items):
+        if i < n:
+            sample.append(item)
+        else:
+            j = rand.randint(0, i)
+            if j < n:
+                sample[j] = item
+    return sample
+
+
+def endpoint_type(path):
+    """
+    Get the type of endpoint a Graph API path refers to.
+    
+    @param path: The Graph API path
+    @type  path: C{str}
+    @return: The connection name, 'object' for plain objects, or 'batch' for the batch endpoint
+    @rtype: C{str}
+    """
+    parts = path.strip('/').split('/')
+    if not parts[0]:
+        return 'batch'
+    return parts[1] if len(parts) > 1 else 'object'
+
+
+class GraphStats(object):
+    """
+    Thread-safe counters describing the traffic sent to the Graph API.
+    
+    For each type of endpoint (object, friends, feed, likes, ...) this keeps
+    the number of calls and cache hits, a latency histogram, the number of
+    response bytes, the number of retries, and the error codes received.
+    """
+    
+    buckets = 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    """Upper bounds, in seconds, of the latency histogram buckets
+    @type: C{tuple}"""
+    
+    def __init__(self):
+        """
+        Create empty counters.
+        """
+        self._endpoints = {}
+        self._lock = threading.Lock()
+    
+    def record(self, endpoint, latency=None, size=0, retries=0, errors=(), cached=False):
+        """
+        Record a single call.
+        
+        @param endpoint: The type of endpoint, as returned by endpoint_type
+        @type  endpoint: C{str}
+        @param latency: Seconds the call took, or None if it was not timed
+        @type  latency: C{float}
+        @param size: The number of response bytes
+        @type  size: C{int}
+        @param retries: The number of times the call was retried
+        @type  retries: C{int}
+        @param errors: The error codes received, if any
+        @type  errors: C{list}
+        @param cached: Whether the response came from the cache
+        @type  cached: C{bool}
+        """
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {'calls': 0, 'cached': 0, 'bytes': 0, 'retries': 0, 'time': 0.0,
+                                                     'latency': [0] * (len(self.buckets) + 1), 'errors': {}}
+            stats['calls'] += 1
+            stats['cached'] += int(cached)
+            stats['bytes'] += size
+            stats['retries'] += retries
+            if latency is not None:
+                stats['time'] += latency
+                stats['latency'][bisect.bisect_left(self.buckets, latency)] += 1
+            for code in errors:
+                stats['errors'][code] = stats['errors'].get(code, 0) + 1
+    
+    def summary(self):
+        """
+        Get a copy of the counters.
+        
+        @return: The counters for each endpoint type, with the latency histogram as (bucket, count) pairs
+        @rtype: C{dict}
+        """
+        labels = ["<={0}s".format(bound) for bound in self.buckets] + [">{0}s".format(self.buckets[-1])]
+        with self._lock:
+            summary = {}
+            for endpoint, stats in self._endpoints.iteritems():
+                summary[endpoint] = dict(stats, errors=dict(stats['errors']),
+                                         latency=zip(labels, stats['latency']))
+            return summary
+    
+    def dump(self, logger):
+        """
+        Log one line of counters for each endpoint type.
+        
+        @param logger: The logger to write to
+        @type  logger: C{logging.Logger}
+        """
+        for endpoint, stats in sorted(self.summary().iteritems()):
+            logger.info("Graph {0}: {1} calls ({2} cached), {3} bytes, {4} retries, {5:.2f}s total, errors {6}, latency {7}".format(
+                endpoint, stats['calls'], stats['cached'], stats['bytes'], stats['retries'], stats['time'],
+                stats['errors'], stats['latency']))
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of persistent HTTPS connections.
+    
+    Connections are kept alive between requests so that each Graph call does
+    not need a new TCP and TLS handshake. Connections that sit idle longer
+    than the idle timeout are closed instead of being reused.
+    """
+    
+    def __init__(self, host, size=4, idle_timeout=60, timeout=30):
+        """
+        Create an empty pool.
+        
+        @param host: The host to connect to
+        @type  host: C{str}
+        @param size: The maximum number of idle connections to keep
+        @type  size: C{int}
+        @param idle_timeout: Seconds an idle connection may be kept before it is discarded
+        @type  idle_timeout: C{int}
+        @param timeout: Socket timeout for each connection
+        @type  timeout: C{int}
+        """
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def get(self):
+        """
+        Take a connection from the pool, opening a new one if none are usable.
+        
+        @return: An HTTPS connection to the pool's host
+        @rtype: C{httplib.HTTPSConnection}
+        """
+        stale = []
+        conn = None
+        with self._lock:
+            now = time.time()
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+            if conn is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        for old in stale:
+            old.close()
+        if conn is None:
+            conn = self.connect()
+        return conn
+    
+    def connect(self):
+        """
+        Open a new connection without taking one from the pool.
+        
+        @return: An HTTPS connection to the pool's host
+        @rtype: C{httplib.HTTPSConnection}
+        """
+        return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+    
+    def put(self, conn):
+        """
+        Return a connection to the pool so that it can be reused.
+        
+        If the pool is already full, the connection is closed instead.
+        
+        @param conn: The connection to return
+        @type  conn: C{httplib.HTTPSConnection}
+        """
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+    
+    def close(self):
+        """
+        Close all idle connections in the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+    
+    def stats(self):
+        """
+        Get the pool hit and miss counters.
+        
+        @return: The number of hits, misses, and currently idle connections
+        @rtype: C{dict}
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'idle': len(self._idle)}
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket limiting how fast requests are sent.
+    
+    Every request takes one token. Tokens are refilled at a fixed rate up to
+    the burst size, and a throttled response can pause the bucket so that all
+    threads sharing it back off together. Given a path, the bucket is kept in
+    that file and updated under an exclusive lock, so that every process
+    using the same file, such as separate Celery workers, shares one bucket
+    and one pause.
+    """
+    
+    def __init__(self, rate=10, burst=20, path=None):
+        """
+        Create a full bucket.
+        
+        @param rate: The number of tokens added per second
+        @type  rate: C{float}
+        @param burst: The maximum number of tokens the bucket holds
+        @type  burst: C{int}
+        @param path: A file to keep the bucket in so that it is shared between processes, or None to keep it in memory
+        @type  path: C{str}
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.path = path
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def _update(self, change):
+        """
+        Change the state of the bucket atomically.
+        
+        @param change: Function taking the token count, the last refill time, and the end of the
+                       current pause, and returning the new values and a result
+        @type  change: C{function}
+        @return: The result of change
+        @rtype: mixed
+        """
+        with self._lock:
+            if self.path is None or fcntl is None:
+                state, result = change((self._tokens, self._updated, self._paused_until))
+                self._tokens, self._updated, self._paused_until = state
+                return result
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = tuple(float(value) for value in os.read(fd, 256).split())
+                except ValueError:
+                    state = ()
+                if len(state) != 3:
+                    state = (float(self.burst), time.time(), 0.0)
+                state, result = change(state)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, "{0!r} {1!r} {2!r}".format(*state))
+                return result
+            finally:
+                # Closing the file releases the lock.
+                os.close(fd)
+    
+    def acquire(self):
+        """
+        Take a token, blocking until one is available.
+        """
+        def take(state):
+            tokens, updated, paused_until = state
+            now = time.time()
+            if now < paused_until:
+                return (tokens, updated, paused_until), paused_until - now
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                return (tokens - 1, now, paused_until), 0
+            return (tokens, now, paused_until), (1 - tokens) / self.rate
+        
+        while True:
+            wait = self._update(take)
+            if not wait:
+                return
+            time.sleep(wait)
+    
+    def pause(self, seconds):
+        """
+        Empty the bucket and stop handing out tokens for a while.
+        
+        @param seconds: How long to wait before refilling
+        @type  seconds: C{float}
+        """
+        def stop(state):
+            paused_until = max(state[2], time.time() + seconds)
+            return (0.0, paused_until, paused_until), None
+        
+        self._update(stop)
+
+
+class ResponseCache(object):
+    """
+    A persistent on-disk cache of raw Graph API responses.
+    
+    Each response is stored in its own file, keyed on the request path and
+    arguments. The access token is left out of the key so users fetched by
+    ID are shared between participants, except for paths under C{me}, whose
+    response depends on whose token is used. Entries expire after a TTL that
+    depends on the type of endpoint, and the least recently used entries are
+    removed once the cache grows beyond its size cap. Files are written to a
+    temporary name and renamed into place, so several processes can safely
+    share one cache directory.
+    """
+    
+    ttls = {'object': 86400, 'friends': 86400, 'feed': 3600, 'likes': 86400}
+    """Seconds a response stays fresh, by endpoint type
+    @type: C{dict}"""
+    
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, ttls=None, default_ttl=3600):
+        """
+        Open a cache directory, creating it if necessary.
+        
+        @param directory: The directory to store responses in
+        @type  directory: C{str}
+        @param max_bytes: The maximum total size of the cached responses
+        @type  max_bytes: C{int}
+        @param ttls: Overrides for the per-endpoint TTLs
+        @type  ttls: C{dict}
+        @param default_ttl: TTL for endpoint types not in ttls
+        @type  default_ttl: C{int}
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker may have created it first.
+                if not os.path.isdir(directory):
+                    raise
+    
+    def _filename(self, path, args, token=None):
+        """
+        Get the file a response is stored in.
+        
+        @param path: The Graph API path
+        @type  path: C{str}
+        @param args: The GET arguments of the request
+        @type  args: C{dict}
+        @param token: The access token the request is made with
+        @type  token: C{str}
+        @return: The absolute path of the cache file
+        @rtype: C{str}
+        """
+        key = path + "?" + urllib.urlencode(sorted((k, v) for k, v in args.iteritems() if k != 'access_token'))
+        if token and path.split('/', 1)[0] == 'me':
+            # Only the hash of the key is stored, never the token itself.
+            key += "#" + token
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+    
+    def get(self, path, args, token=None):
+        """
+        Get a cached response if it exists and has not expired.
+        
+        @param path: The Graph API path
+        @type  path: C{str}
+        @param args: The GET arguments of the request
+        @type  args: C{dict}
+        @param token: The access token the request is made with
+        @type  token: C{str}
+        @return: The raw response, or None if it is not cached
+        @rtype: C{str}
+        """
+        filename = self._filename(path, args, token)
+        try:
+            with open(filename, 'rb') as fp:
+                created = float(fp.readline())
+                body = fp.read()
+        except (IOError, ValueError):
+            return None
+        if time.time() - created > self.ttls.get(endpoint_type(path), self.default_ttl):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
         try:
-            import simplejson
-            if parser:
-                _parse_json = lambda s: simplejson.loads(s)
+            # The modification time records when the entry was last used.
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return body
+    
+    def put(self, path, args, body, token=None):
+        """
+        Store a response, evicting old entries if the cache is too large.
+        
+        @param path: The Graph API path
+        @type  path: C{str}
+        @param args: The GET arguments of the request
+        @type  args: C{dict}
+        @param body: The raw response
+        @type  body: C{str}
+        @param token: The access token the request was made with
+        @type  token: C{str}
+        """
+        filename = self._filename(path, args, token)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write("{0!r}\n".format(time.time()))
+                fp.write(body)
+                added = fp.tell()
+            try:
+                # An expired or concurrently written entry is replaced, not added.
+                added -= os.stat(filename).st_size
+            except OSError:
+                pass
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += added
+            # The count only covers this process's writes, so once it passes
+            # the cap the directory is scanned again to find the real size.
+            if self._size is None or self._size > self.max_bytes:
+                self._size = self.evict()
+    
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its size cap.
+        
+        @return: The total size of the remaining entries
+        @rtype: C{int}
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            # Temporary files and state such as a shared rate limiter are not cache entries.
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+        return total
+
+
+class GraphAPI(object):
+    """A client for the Facebook Graph API.
+
+    The Graph API is made up of the objects in Facebook (e.g., people, pages,
+    events, photos) and the connections between them (e.g., friends,
+    photo tags, and event RSVPs).
+
+    You can see a list of all of the objects and connections supported
+    by the API at http://developers.facebook.com/docs/reference/api/.
+
+    You can obtain an access token via OAuth. See http://developers.facebook.com/docs/authentication/
+    for details.
+    """
+    
+    host = "graph.facebook.com"
+    """The host serving the Graph API
+    @type: C{str}"""
+    
+    batch_limit = 50
+    """The maximum number of requests the Graph API accepts in one batch
+    @type: C{int}"""
+    
+    throttle_codes = frozenset([4, 17, 32, 341, 613])
+    """Graph API error codes meaning the app or user is being rate limited
+    @type: C{frozenset}"""
+    
+    transient_codes = frozenset([1, 2])
+    """Graph API error codes for temporary failures that are worth retrying
+    @type: C{frozenset}"""
+    
+    max_attempts = 5
+    """The maximum number of times a request is attempted
+    @type: C{int}"""
+    
+    backoff_base = 0.5
+    """Seconds to wait before the first retry; doubled for each later retry
+    @type: C{float}"""
+    
+    backoff_max = 60
+    """The longest time to wait between retries
+    @type: C{float}"""
+    
+    throttle_attempts = 10
+    """The maximum number of times a request is attempted while it is being throttled
+    @type: C{int}"""
+    
+    throttle_backoff = 60
+    """The shortest time to pause requests after being throttled, since throttling lasts for minutes
+    @type: C{float}"""
+    
+    limiter = RateLimiter()
+    """The rate limiter shared by every GraphAPI in the process; pass a file-backed one to share it between processes
+    @type: L{RateLimiter}"""
+    
+    def __init__(self, logger, json, access_token=None, pool_size=4, idle_timeout=60, json_dump=None, cache=None,
+                 limiter=None, stream=False, json_load=None):
+        """
+        Store the access token and set up the connection pool.
+        
+        @param access_token: The Oauth access token from Facebook
+        @type  access_token: C{Str}
+        @param pool_size: The maximum number of persistent connections to keep
+        @type  pool_size: C{int}
+        @param idle_timeout: Seconds before an idle connection is discarded
+        @type  idle_timeout: C{int}
+        @param json_dump: JSON serializer used for batch requests
+        @type  json_dump: C{function}
+        @param cache: An optional on-disk cache of responses
+        @type  cache: L{ResponseCache}
+        @param limiter: A rate limiter to use instead of the shared one
+        @type  limiter: L{RateLimiter}
+        @param stream: Whether to parse uncached connection pages item by item as they arrive
+        @type  stream: C{bool}
+        @param json_load: JSON parser reading from a file, used to decode responses that are not cached
+        @type  json_load: C{function}
+        """
+        self.logger = logger
+        self._parse_json = json
+        self._dump_json = json_dump or find_json(logger, False)
+        self._load_json = json_load or find_json_load(logger)
+        self.access_token = access_token
+        self.pool = ConnectionPool(self.host, pool_size, idle_timeout)
+        self.cache = cache
+        if limiter is not None:
+            self.limiter = limiter
+        self._random = random.Random()
+        self._stream_json = find_stream_json(logger) if stream else None
+        self.stats = GraphStats()
+    
+    def get_object(self, ids, **args):
+        """
+        Fetchs the given object from the graph.
+        
+        @param ids: An ID or a list of IDs to get
+        @type  ids: C{int} or C{list} of C{int}s
+        @return: Either the object or a list of objects
+        @rtype: mixed
+        """
+        if isinstance(ids, list) or isinstance(ids, set):
+            args["ids"] = ",".join(ids)
+        elif not isinstance(ids, str) and not isinstance(ids, unicode):
+            self.logger.error("Invalid object ID type passed to graph API.")
+            raise Exception("Invalid id type {0}.".format(type(ids)))
+        return self.request(ids, args)
+
+    def get_connection(self, conn_id, connection_name, **args):
+        """
+        Fetchs the connections for given object.
+        
+        Gets a given connection for an object. Pass the limit argument to
+        set how many connections to get.
+        
+        @param conn_id: The ID of the parent object
+        @type  conn_id: C{int}
+        @param connection_name: The name of the connection to get
+        @type  connection_name: C{str}
+        @return: A list of connections
+        @rtype: C{list}
+        """
+        return self.request(conn_id + "/" + connection_name, args)
+
+    def iter_connection(self, conn_id, connection_name, since=None, until=None, max_items=None, **args):
+        """
+        Lazily iterates over all of the connections for a given object.
+        
+        Pages are requested one at a time as the previous one is used up, by
+        following the paging cursors returned by Facebook, so only a single
+        page is held in memory at once. In streaming mode not even that: each
+        item is parsed from the response as it is read.
+        
+        @param conn_id: The ID of the parent object
+        @type  conn_id: C{int}
+        @param connection_name: The name of the connection to get
+        @type  connection_name: C{str}
+        @param since: Only get connections created after this time
+        @type  since: datetime.datetime
+        @param until: Only get connections created before this time
+        @type  until: datetime.datetime
+        @param max_items: The maximum number of connections to yield, or None for all
+        @type  max_items: C{int}
+        @return: An iterator over the connections
+        @rtype: C{generator}
+        """
+        if since is not None:
+            args['since'] = calendar.timegm(since.utctimetuple())
+        if until is not None:
+            args['until'] = calendar.timegm(until.utctimetuple())
+        if self._stream_json is not None and self.cache is None:
+            pages = self._iter_pages(None, conn_id + "/" + connection_name, args, max_items)
+        else:
+            pages = self.iter_pages(self.get_connection(conn_id, connection_name, **args), max_items)
+        for item in pages:
+            yield item
+
+    def iter_pages(self, page, max_items=None):
+        """
+        Lazily iterates over a paged response and every page following it.
+        
+        @param page: The first page of a connection, as returned by get_connection
+        @type  page: C{dict}
+        @param max_items: The maximum number of connections to yield, or None for all
+        @type  max_items: C{int}
+        @return: An iterator over the connections
+        @rtype: C{generator}
+        """
+        return self._iter_pages(page, None, None, max_items)
+
+    def _iter_pages(self, page, path, args, max_items):
+        """
+        Iterates over a connection starting either from a fetched page or from a path.
+        
+        @param page: The first page, or None to request path with args
+        @type  page: C{dict}
+        @param path: The path of the first page, if page is None
+        @type  path: C{str}
+        @param args: The GET arguments of the first page, if page is None
+        @type  args: C{dict}
+        @param max_items: The maximum number of connections to yield, or None for all
+        @type  max_items: C{int}
+        @return: An iterator over the connections
+        @rtype: C{generator}
+        """
+        count = 0
+        while True:
+            if page is None and self._stream_json is not None and self.cache is None:
+                page = {}
+                data = self._stream_page(path, args, page)
             else:
-                _parse_json = lambda s: simplejson.dumps(s)
-        except ImportError:
+                if page is None:
+                    page = self.request(path, args)
+                data = page.get('data', [])
+            empty = True
+            for item in data:
+                if max_items is not None and count >= max_items:
+                    return
+                empty = False
+                count += 1
+                yield item
+            next_url = page.get('paging', {}).get('next')
+            if empty or not next_url:
+                return
+            self.logger.debug("Following paging cursor to the next page.")
+            next_url = urlparse.urlparse(next_url)
+            args = dict(urlparse.parse_qsl(next_url.query))
+            args.pop('access_token', None)
+            path = next_url.path.lstrip('/')
+            page = None
+
+    def _stream_page(self, path, args, page):
+        """
+        Requests a page and parses its items one at a time from the response.
+        
+        The paging cursor is stored in page once the response has been read.
+        Errors that arrive before the first item are retried like those of
+        L{request}. Once items have been used they cannot be taken back, so
+        a later error is raised. Streamed pages are not cached.
+        
+        @param path: The path to the connection
+        @type  path: C{str}
+        @param args: GET arguments to append to the request
+        @type  args: C{dict}
+        @param page: A dict that receives the page's paging cursor
+        @type  page: C{dict}
+        @return: An iterator over the page's items
+        @rtype: C{generator}
+        """
+        if self.access_token:
+            args["access_token"] = self.access_token
+        url = "/" + path + "?" + urllib.urlencode(args)
+        self.logger.debug("Streaming {0} from Facebook.".format(path))
+        attempt = 0
+        errors = []
+        start = time.time()
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            conn = self.pool.get()
+            error = None
+            started = False
             try:
-                # For Google AppEngine
-                from django.utils import simplejson
-                if parser:
-                    _parse_json = lambda s: simplejson.loads(s)
-                else:
-                    _parse_json = lambda s: simplejson.dumps(s)
-            except ImportError:
-                logger.critical("JSON parser not found.")
+                conn.request('GET', url)
+                resp = conn.getresponse()
+                for kind, value in self._stream_json(resp):
+                    if kind == 'item':
+                        started = True
+                        yield value
+                    elif kind == 'next':
+                        page['paging'] = {'next': value}
+                    else:
+                        error = value
+                        break
+            except (IOError, httplib.HTTPException), e:
+                conn.close()
+                if started:
+                    raise IOError(e)
+                error = {'type': type(e).__name__, 'message': str(e)}
+            except:
+                # Includes the generator being closed before the response was read.
+                conn.close()
                 raise
-    finally:
-        return _parse_json
+            if error is None:
+                break
+            # The rest of the response is not read, so the connection cannot be reused.
+            conn.close()
+            self.logger.debug("Error received from Facebook: {0}".format(error["message"]))
+            code = error.get("code")
+            errors.append(code if code is not None else error["type"])
+            if started or not self._can_retry(code, attempt):
+                self.logger.error("Failed to retrieve {0} from Facebook.".format(path))
+                self.stats.record(endpoint_type(path), time.time() - start, retries=attempt - 1, errors=errors)
+                raise Exception(error["type"], error["message"])
+            self._wait(path, attempt, code in self.throttle_codes)
+        self.stats.record(endpoint_type(path), time.time() - start, retries=attempt - 1, errors=errors)
+        if resp.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self.pool.put(conn)
 
+    def batch(self):
+        """
+        Start a new batch of requests.
+        
+        Calls to get_object and get_connection on the returned object are
+        queued and sent together when it is executed.
+        
+        @return: An empty batch bound to this graph
+        @rtype: L{BatchRequest}
+        """
+        return BatchRequest(self)
+
+    def batch_request(self, requests):
+        """
+        Fetches several paths in the Graph API using the batch endpoint.
+        
+        The requests are split into chunks of at most batch_limit, and each
+        chunk is sent as a single HTTP request. Items that fail with a
+        throttling or transient error are retried with the same backoff and
+        attempt limits as L{request}, resending only the failed items.
+        
+        @param requests: The paths and GET arguments of each request
+        @type  requests: C{list} of C{tuple} with C{str} and C{dict}
+        @return: The responses, in the same order as the requests
+        @rtype: C{list}
+        """
+        results = [None] * len(requests)
+        pending = []
+        for i, (path, args) in enumerate(requests):
+            cached = self.cache.get(path, args, self.access_token) if self.cache else None
+            if cached is not None:
+                self.stats.record(endpoint_type(path), size=len(cached), cached=True)
+                results[i] = self._parse_json(cached)
+            else:
+                pending.append(i)
+        for start in range(0, len(pending), self.batch_limit):
+            chunk = pending[start:start + self.batch_limit]
+            attempts = dict.fromkeys(chunk, 0)
+            errors = dict((i, []) for i in chunk)
+            while chunk:
+                self.logger.debug("Sending batch of {0} requests to Facebook.".format(len(chunk)))
+                batch = [{'method': 'GET', 'relative_url': path + ("?" + urllib.urlencode(args) if args else "")}
+                         for path, args in [requests[i] for i in chunk]]
+                responses = self.request("", post_args={'batch': self._dump_json(batch)})
+                retry = []
+                throttled = False
+                for i, item in zip(chunk, responses):
+                    path, args = requests[i]
+                    attempts[i] += 1
+                    response = self._parse_json(item['body']) if item and item.get('body') else {}
+                    if item is None or (isinstance(response, dict) and response.get("error")):
+                        error = response.get("error", {'type': 'Exception', 'message': 'No response'})
+                        code = error.get("code")
+                        errors[i].append(code if code is not None else error["type"])
+                        self.logger.debug("Error received from Facebook: {0}".format(error["message"]))
+                        if self._can_retry(code, attempts[i]):
+                            retry.append(i)
+                            throttled = throttled or code in self.throttle_codes
+                            continue
+                        self.stats.record(endpoint_type(path), retries=attempts[i] - 1, errors=errors[i])
+                        self.logger.error("Failed to retrieve {0} from Facebook.".format(path))
+                        raise Exception(error["type"], error["message"])
+                    self.stats.record(endpoint_type(path), size=len(item['body']), retries=attempts[i] - 1,
+                                      errors=errors[i])
+                    if self.cache:
+                        self.cache.put(path, args, item['body'], self.access_token)
+                    results[i] = response
+                if retry:
+                    self._wait("{0} batched requests".format(len(retry)), max(attempts[i] for i in retry), throttled)
+                chunk = retry
+        return results
+
+    def request(self, path, args=None, post_args=None):
+        """
+        Fetches the given path in the Graph API.
+
+        We translate args to a valid query string. If post_args is given,
+        we send a POST request to the given path with the given arguments.
+        
+        @param path: The path to the object to retrieve from the graph
+        @type  path: C{str}
+        @param args: GET arguments to append to the request
+        @type  args: C{list}
+        @param post_args: POST arguments to send in the request body
+        @type  post_args: C{dict}
+        
+        @return: The requested object or connection
+        @rtype: mixed
+        """
+        if not args: args = {}
+        cacheable = self.cache is not None and post_args is None
+        if cacheable:
+            cached = self.cache.get(path, args, self.access_token)
+            if cached is not None:
+                self.logger.debug("Using cached response for {0}.".format(path))
+                self.stats.record(endpoint_type(path), size=len(cached), cached=True)
+                return self._parse_json(cached)
+        cache_args = dict(args)
+        if self.access_token:
+            if post_args is not None:
+                post_args["access_token"] = self.access_token
+            else:
+                args["access_token"] = self.access_token
+        url = "/" + path + "?" + urllib.urlencode(args)
+        body = urllib.urlencode(post_args) if post_args is not None else None
+        self.logger.debug("Requesting {0} from Facebook.".format(path))
+        self.logger.debug("URL: https://" + self.host + url)
+        attempt = 0
+        errors = []
+        start = time.time()
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            try:
+                if cacheable:
+                    raw = self._fetch(url, body)
+                    response = self._parse_json(raw)
+                    size = len(raw)
+                else:
+                    # Nothing needs the raw body, so decode straight from the response.
+                    response, size = self._fetch(url, body, self._load_json)
+            except (IOError, ValueError), e:
+                error = {'type': type(e).__name__, 'message': str(e)}
+            else:
+                error = response.get("error") if isinstance(response, dict) else None
+                if not error:
+                    break
+            self.logger.debug("Error received from Facebook: {0}".format(error["message"]))
+            code = error.get("code")
+            errors.append(code if code is not None else error["type"])
+            if not self._can_retry(code, attempt):
+                self.logger.error("Failed to retrieve {0} from Facebook.".format(path))
+                self.stats.record(endpoint_type(path), time.time() - start, retries=attempt - 1, errors=errors)
+                raise Exception(error["type"], error["message"])
+            self._wait(path, attempt, code in self.throttle_codes)
+        self.stats.record(endpoint_type(path), time.time() - start, size, attempt - 1, errors)
+        if cacheable:
+            self.cache.put(path, cache_args, raw, self.access_token)
+        return response
+    
+    def retry_codes(self):
+        """
+        Get the Graph API error codes that should be retried.
+        
+        @return: The throttling and transient error codes
+        @rtype: C{frozenset}
+        """
+        return self.throttle_codes | self.transient_codes
+    
+    def _can_retry(self, code, attempt):
+        """
+        Check whether a failed request should be attempted again.
+        
+        Errors without a code, such as network errors, are retried like
+        transient errors. Throttled requests get throttle_attempts attempts
+        and everything else gets max_attempts.
+        
+        @param code: The Graph API error code, or None if there was none
+        @type  code: C{int}
+        @param attempt: The number of attempts made so far
+        @type  attempt: C{int}
+        @return: Whether to retry
+        @rtype: C{bool}
+        """
+        if code is not None and code not in self.retry_codes():
+            return False
+        return attempt < (self.throttle_attempts if code in self.throttle_codes else self.max_attempts)
+    
+    def _wait(self, what, attempt, throttled):
+        """
+        Back off before retrying a failed request.
+        
+        A throttled request pauses the rate limiter, holding back every
+        request that shares it, not just this one.
+        
+        @param what: A description of what is being retried, for the log
+        @type  what: C{str}
+        @param attempt: The number of attempts made so far
+        @type  attempt: C{int}
+        @param throttled: Whether the last attempt was throttled
+        @type  throttled: C{bool}
+        """
+        delay = self.backoff(attempt, throttled)
+        if throttled:
+            self.logger.warning("Throttled by Facebook; pausing requests for {0:.1f} seconds.".format(delay))
+            self.limiter.pause(delay)
+        else:
+            self.logger.debug("Retrying {0} in {1:.1f} seconds.".format(what, delay))
+            time.sleep(delay)
+    
+    def backoff(self, attempt, throttled=False):
+        """
+        Get how long to wait before retrying, using exponential backoff with full jitter.
+        
+        Throttled requests wait at least throttle_backoff on top of the jitter.
+        
+        @param attempt: The number of attempts made so far
+        @type  attempt: C{int}
+        @param throttled: Whether the last attempt was throttled
+        @type  throttled: C{bool}
+        @return: The delay in seconds
+        @rtype: C{float}
+        """
+        delay = self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        return delay + self.throttle_backoff if throttled else delay
+    
+    def _fetch(self, url, body=None, load=None):
+        """
+        Perform a GET or POST request over a pooled connection.
+        
+        The connection is returned to the pool only if the response was read
+        completely and the server did not ask to close it. If a reused
+        connection turns out to have been closed by the server before any of
+        the response arrived, the request is sent again at once on a new
+        connection, and the other idle connections, which are likely just as
+        stale, are closed.
+        
+        @param url: The path and query string to request
+        @type  url: C{str}
+        @param body: An encoded POST body, or None to send a GET request
+        @type  body: C{str}
+        @param load: A JSON parser to decode the response with as it is read, or None to return the raw body
+        @type  load: C{function}
+        @return: The raw response body, or the decoded response and its size in bytes if load is given
+        @rtype: C{str} or C{tuple}
+        """
+        conn = self.pool.get()
+        reused = conn.sock is not None
+        try:
+            resp = self._send(conn, url, body)
+        except (IOError, httplib.HTTPException), e:
+            conn.close()
+            if not reused or not self._is_stale(e):
+                raise IOError(e)
+            self.logger.debug("Pooled connection was closed by Facebook; retrying on a new connection.")
+            self.pool.close()
+            conn = self.pool.connect()
+            try:
+                resp = self._send(conn, url, body)
+            except (IOError, httplib.HTTPException), e:
+                conn.close()
+                raise IOError(e)
+        try:
+            if load is None:
+                body = resp.read()
+            else:
+                body = load(resp), int(resp.getheader('content-length', 0))
+                # The connection can only be reused once the whole response has been read.
+                resp.read()
+        except (IOError, httplib.HTTPException), e:
+            conn.close()
+            raise IOError(e)
+        except:
+            conn.close()
+            raise
+        if resp.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self.pool.put(conn)
+        return body
+    
+    def _send(self, conn, url, body):
+        """
+        Send a GET or POST request and wait for the response headers.
+        
+        @param conn: The connection to use
+        @type  conn: C{httplib.HTTPSConnection}
+        @param url: The path and query string to request
+        @type  url: C{str}
+        @param body: An encoded POST body, or None to send a GET request
+        @type  body: C{str}
+        @return: The response, with its body not yet read
+        @rtype: C{httplib.HTTPResponse}
+        """
+        if body is None:
+            conn.request('GET', url)
+        else:
+            conn.request('POST', url, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        return conn.getresponse()
+    
+    @staticmethod
+    def _is_stale(error):
+        """
+        Check whether a request failed because its kept-alive connection had been closed.
+        
+        @param error: The error raised while sending the request
+        @type  error: C{Exception}
+        @return: Whether no response arrived because the connection was already closed
+        @rtype: C{bool}
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+class BatchRequest(object):
+    """
+    A queue of Graph API requests to be sent with the batch endpoint.
+    
+    Each queued call returns the index its response will have in the list
+    returned by execute.
+    """
+    
+    def __init__(self, graph):
+        """
+        Create an empty batch.
+        
+        @param graph: The graph to send the requests through
+        @type  graph: L{GraphAPI}
+        """
+        self.graph = graph
+        self.requests = []
+    
+    def get_object(self, id, **args):
+        """
+        Queue a request for an object.
+        
+        @param id: The ID of the object
+        @type  id: C{str}
+        @return: The index of the response
+        @rtype: C{int}
+        """
+        self.requests.append((id, args))
+        return len(self.requests) - 1
+    
+    def get_connection(self, conn_id, connection_name, **args):
+        """
+        Queue a request for an object's connections.
+        
+        @param conn_id: The ID of the parent object
+        @type  conn_id: C{str}
+        @param connection_name: The name of the connection to get
+        @type  connection_name: C{str}
+        @return: The index of the response
+        @rtype: C{int}
+        """
+        self.requests.append((conn_id + "/" + connection_name, args))
+        return len(self.requests) - 1
+    
+    def execute(self):
+        """
+        Send all queued requests and clear the queue.
+        
+        @return: The responses, in the order the requests were queued
+        @rtype: C{list}
+        """
+        requests, self.requests = self.requests, []
+        return self.graph.batch_request(requests)
 
-class GraphAPI(object):
-    """A client for the Facebook Graph API.
 
-    The Graph API is made up of the objects in Facebook (e.g., people, pages,
-    events, photos) and the connections between them (e.g., friends,
-    photo tags, and event RSVPs).
+class UserRegistry(object):
+    """
+    A bounded, thread-safe cache of User objects shared by the whole process.
+    
+    Users are keyed by their ID, the access token used to fetch them, and
+    the options that change what is stored (how many posts, and whether the
+    wall is columnar), so each distinct user is only fetched once per token
+    and a caller never gets a user loaded differently than it asked for.
+    When the registry is full, the least recently used user is evicted.
+    """
+    
+    def __init__(self, size=1024):
+        """
+        Create an empty registry.
+        
+        @param size: The maximum number of users to keep
+        @type  size: C{int}
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._users = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, graph, logger, user_id, max_posts=500, columnar=False, **args):
+        """
+        Get a user without friend data, fetching it only if it is not cached.
+        
+        @param graph: A GraphAPI object
+        @type  graph: L{GraphAPI}
+        @param user_id: ID of the user
+        @type  user_id: C{str}
+        @param max_posts: The maximum number of wall posts to get, or None for the full history
+        @type  max_posts: C{int}
+        @param columnar: Whether to store the wall in a L{ColumnarWall} rather than a list
+        @type  columnar: C{bool}
+        @return: The user
+        @rtype: L{User}
+        """
+        key = (graph.access_token, user_id, max_posts, bool(columnar))
+        with self._lock:
+            user = self._users.pop(key, None)
+            if user is not None:
+                self._users[key] = user
+                self.hits += 1
+                return user
+            self.misses += 1
+        user = User(graph, logger, user_id, 0, max_posts=max_posts, columnar=columnar, **args)
+        self.add(user, user_id)
+        return user
+    
+    def add(self, user, user_id=None):
+        """
+        Add a user to the registry, evicting the least recently used users if necessary.
+        
+        @param user: The user to add
+        @type  user: L{User}
+        @param user_id: The ID the user was requested with, if not its own ID
+        @type  user_id: C{str}
+        """
+        key = (user.graph.access_token, user_id or user.identity['id'], user.options['max_posts'],
+               bool(user.options['columnar']))
+        with self._lock:
+            self._users.pop(key, None)
+            self._users[key] = user
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        """
+        Remove all users from the registry.
+        """
+        with self._lock:
+            self._users.clear()
+    
+    def stats(self):
+        """
+        Get the registry hit, miss, and eviction counters.
+        
+        @return: The counters, the hit rate, and the number of cached users
+        @rtype: C{dict}
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': float(self.hits) / total if total else 0.0, 'size': len(self._users)}
 
-    You can see a list of all of the objects and connections supported
-    by the API at http://developers.facebook.com/docs/reference/api/.
 
-    You can obtain an access token via OAuth. See http://developers.facebook.com/docs/authentication/
-    for details.
+class Post(object):
+    """
+    A compact wall post.
+    
+    Only what the feature extraction needs is kept: interned IDs for the
+    post, its author, and the users who liked and commented on it, the
+    creation time in seconds since the epoch, and the number of words in
+    the message.
     """
     
-    def __init__(self, logger, json, access_token=None):
+    __slots__ = 'id', 'author', 'created_time', 'size', 'likers', 'commenters'
+    
+    def __init__(self, id, author, created_time, size=0, likers=(), commenters=()):
         """
-        Store the access token.
+        Create a post.
         
-        @param access_token: The Oauth access token from Facebook
-        @type  access_token: C{Str}
+        @param id: ID of the post
+        @type  id: C{str}
+        @param author: ID of the user who wrote the post
+        @type  author: C{str}
+        @param created_time: When the post was made, in seconds since the epoch
+        @type  created_time: C{int}
+        @param size: The number of words in the message
+        @type  size: C{int}
+        @param likers: IDs of the users who liked the post
+        @type  likers: C{tuple} of C{str}
+        @param commenters: IDs of the users who commented on the post, once per comment
+        @type  commenters: C{tuple} of C{str}
         """
-        self.logger = logger
-        self._parse_json = json
-        self.access_token = access_token
+        self.id = id
+        self.author = author
+        self.created_time = created_time
+        self.size = size
+        self.likers = likers
+        self.commenters = commenters
     
-    def get_object(self, ids, **args):
+    @classmethod
+    def from_graph(cls, post):
         """
-        Fetchs the given object from the graph.
+        Create a post from a post object returned by the Graph API.
         
-        @param ids: An ID or a list of IDs to get
-        @type  ids: C{int} or C{list} of C{int}s
-        @return: Either the object or a list of objects
-        @rtype: mixed
+        @param post: The post from the feed connection
+        @type  post: C{dict}
+        @return: The compact post
+        @rtype: L{Post}
         """
-        if isinstance(ids, list) or isinstance(ids, set):
-            args["ids"] = ",".join(ids)
-        elif not isinstance(ids, str) and not isinstance(ids, unicode):
-            self.logger.error("Invalid object ID type passed to graph API.")
-            raise Exception("Invalid id type {0}.".format(type(ids)))
-        return self.request(ids, args)
+        return cls(intern_id(post['id']), intern_id(post['from']['id']), graph_time(post['created_time']),
+                   len(post.get('message', '').split()),
+                   tuple(intern_id(like['id']) for like in post.get('likes', {}).get('data', [])),
+                   tuple(intern_id(comm['from']['id']) for comm in post.get('comments', {}).get('data', [])))
+    
+    def __repr__(self):
+        return "Post({0!r}, {1!r}, {2!r}, {3!r}, {4!r}, {5!r})".format(
+            self.id, self.author, self.created_time, self.size, self.likers, self.commenters)
 
-    def get_connection(self, conn_id, connection_name, **args):
+
+class WallIndex(object):
+    """
+    An index of a wall for answering wall_filter queries without scanning it.
+    
+    Posts are referred to by their position in the wall. The index keeps the
+    positions sorted by creation time for range queries, and maps each user
+    ID to the positions of the posts they wrote, liked, or commented on.
+    """
+    
+    def __init__(self, wall):
         """
-        Fetchs the connections for given object.
+        Index a wall.
         
-        Gets a given connection for an object. Pass the limit argument to
-        set how many connections to get.
+        @param wall: The wall posts, as stored in L{User.wall}
+        @type  wall: C{list} of L{Post}
+        """
+        self.created = [post.created_time for post in wall]
+        self.order = sorted(range(len(wall)), key=self.created.__getitem__)
+        self.times = [self.created[i] for i in self.order]
+        self.authors = {}
+        self.likers = {}
+        self.commenters = {}
+        for i, post in enumerate(wall):
+            self.authors.setdefault(post.author, set()).add(i)
+            for liker in post.likers:
+                self.likers.setdefault(liker, set()).add(i)
+            for commenter in post.commenters:
+                self.commenters.setdefault(commenter, set()).add(i)
+    
+    def between(self, time_start=None, time_end=None):
+        """
+        Get the positions of the posts created strictly between two times.
         
-        @param conn_id: The ID of the parent object
-        @type  conn_id: C{int}
-        @param connection_name: The name of the connection to get
-        @type  connection_name: C{str}
-        @return: A list of connections
-        @rtype: C{list}
+        @param time_start: The start of the interval in seconds since the epoch, or None for no start
+        @type  time_start: C{int}
+        @param time_end: The end of the interval in seconds since the epoch, or None for no end
+        @type  time_end: C{int}
+        @return: The positions of the matching posts
+        @rtype: C{list} of C{int}
         """
-        return self.request(conn_id + "/" + connection_name, args)
+        lo = 0
+        hi = len(self.times)
+        if time_start is not None:
+            lo = bisect.bisect_right(self.times, time_start)
+        if time_end is not None:
+            hi = bisect.bisect_left(self.times, time_end)
+        return self.order[lo:hi]
+    
+    def filter(self, time_start=None, time_end=None, author=None, liker=None, commenter=None, intersect=True):
+        """
+        Get the positions of the posts matching a wall_filter query.
+        
+        @param time_start: Only match posts after this time, or None
+        @type  time_start: C{int}
+        @param time_end: Only match posts before this time, or None
+        @type  time_end: C{int}
+        @param author: Only match posts written by this user ID, or None
+        @type  author: C{str}
+        @param liker: Only match posts liked by this user ID, or None
+        @type  liker: C{str}
+        @param commenter: Only match posts commented on by this user ID, or None
+        @type  commenter: C{str}
+        @param intersect: Whether posts must match all of the person filters, rather than any
+        @type  intersect: C{bool}
+        @return: The sorted positions of the matching posts
+        @rtype: C{list} of C{int}
+        """
+        # Look up the posts matching each person filter in the inverted indexes.
+        matches = []
+        if author is not None:
+            matches.append(self.authors.get(author, ()))
+        if liker is not None:
+            matches.append(self.likers.get(liker, ()))
+        if commenter is not None:
+            matches.append(self.commenters.get(commenter, ()))
+        
+        if intersect and not matches:
+            return sorted(self.between(time_start, time_end))
+        elif intersect:
+            smallest = min(matches, key=len)
+            positions = [i for i in smallest if all(i in match for match in matches)]
+        else:
+            positions = set().union(*matches)
+        if time_start is not None:
+            positions = [i for i in positions if self.created[i] > time_start]
+        if time_end is not None:
+            positions = [i for i in positions if self.created[i] < time_end]
+        return sorted(positions)
+
 
-    def request(self, path, args=None):
+class InteractionTimeline(object):
+    """
+    Interaction times with prefix counts, for counting interactions in any time window.
+    
+    The distinct times are kept sorted next to the cumulative number of
+    interactions up to each of them, so the number of interactions in an
+    interval takes two bisections no matter how long the timeline is.
+    """
+    
+    def __init__(self, times):
         """
-        Fetches the given path in the Graph API.
+        Build a timeline.
+        
+        @param times: The time of each interaction in seconds since the epoch; may repeat
+        @type  times: iterable of C{int}
+        """
+        counts = collections.Counter(times)
+        self.times = sorted(counts)
+        self.prefix = [0]
+        for t in self.times:
+            self.prefix.append(self.prefix[-1] + counts[t])
+    
+    def __len__(self):
+        return self.prefix[-1]
+    
+    def count(self, time_start, time_end):
+        """
+        Count the interactions strictly between two times.
+        
+        @param time_start: The start of the interval
+        @type  time_start: C{int}
+        @param time_end: The end of the interval
+        @type  time_end: C{int}
+        @return: The number of interactions
+        @rtype: C{int}
+        """
+        hi = self.prefix[bisect.bisect_left(self.times, time_end)]
+        lo = self.prefix[bisect.bisect_right(self.times, time_start)]
+        return max(hi - lo, 0)
+    
+    def window(self, time, length):
+        """
+        Count the interactions in the window of a given length ending at a time.
+        
+        @param time: The end of the window, which is excluded
+        @type  time: C{int}
+        @param length: The length of the window in seconds
+        @type  length: C{int}
+        @return: The number of interactions
+        @rtype: C{int}
+        """
+        return self.count(time - length, time)
+    
+    def last_before(self, time):
+        """
+        Get the time of the last interaction strictly before a given time.
+        
+        @param time: The time to look before
+        @type  time: C{int}
+        @return: The time of the interaction, or None if there was none
+        @rtype: C{int}
+        """
+        i = bisect.bisect_left(self.times, time)
+        return self.times[i - 1] if i else None
 
-        We translate args to a valid query string. If post_args is given,
-        we send a POST request to the given path with the given arguments.
+
+class ColumnarWall(object):
+    """
+    A wall stored column-wise in NumPy arrays.
+    
+    This is an alternative to a list of L{Post} objects for users with large
+    histories. Creation times are kept as int64, authors as int32 codes into
+    a table of IDs, and likers and commenters as CSR-style offset arrays, so
+    wall_filter queries become vectorized mask operations. Indexing the wall
+    still returns L{Post} objects, built on demand.
+    """
+    
+    def __init__(self, posts):
+        """
+        Store posts column-wise.
         
-        @param path: The path to the object to retrieve from the graph
-        @type  path: C{str}
-        @param args: GET arguments to append to the request
-        @type  args: C{list}
+        @param posts: The posts to store
+        @type  posts: iterable of L{Post}
+        """
+        if numpy is None:
+            raise ImportError("NumPy is required for the columnar wall backend.")
+        self.ids = []
+        self.users = []
+        self.codes = {}
+        times = []
+        authors = []
+        sizes = []
+        like_offsets = [0]
+        like_users = []
+        comment_offsets = [0]
+        comment_users = []
+        for post in posts:
+            self.ids.append(post.id)
+            times.append(post.created_time)
+            authors.append(self._code(post.author))
+            sizes.append(post.size)
+            like_users.extend(self._code(liker) for liker in post.likers)
+            like_offsets.append(len(like_users))
+            comment_users.extend(self._code(commenter) for commenter in post.commenters)
+            comment_offsets.append(len(comment_users))
+        self.times = numpy.array(times, dtype=numpy.int64)
+        self.authors = numpy.array(authors, dtype=numpy.int32)
+        self.sizes = numpy.array(sizes, dtype=numpy.int32)
+        self.like_offsets = numpy.array(like_offsets, dtype=numpy.int64)
+        self.like_users = numpy.array(like_users, dtype=numpy.int32)
+        self.comment_offsets = numpy.array(comment_offsets, dtype=numpy.int64)
+        self.comment_users = numpy.array(comment_users, dtype=numpy.int32)
+        # The post each like and comment belongs to, for scattering matches back onto posts.
+        self.like_posts = numpy.repeat(numpy.arange(len(self.ids)), numpy.diff(self.like_offsets))
+        self.comment_posts = numpy.repeat(numpy.arange(len(self.ids)), numpy.diff(self.comment_offsets))
+    
+    def _code(self, user_id):
+        """
+        Get the integer code of a user ID, assigning a new one if necessary.
         
-        @return: The requested object or connection
-        @rtype: mixed
+        @param user_id: The user ID
+        @type  user_id: C{str}
+        @return: The code
+        @rtype: C{int}
         """
-        if not args: args = {}
-        if self.access_token:
-            args["access_token"] = self.access_token
-        self.logger.debug("Requesting {0} from Facebook.".format(path))
-        self.logger.debug("URL: https://graph.facebook.com/" + path + "?" + urllib.urlencode(args))
-        success = 0
-        while success < 3:
-            try:
-                file = urllib.urlopen("https://graph.facebook.com/" + path + "?" + urllib.urlencode(args))
-                response = self._parse_json(file.read())
-            except IOError:
-                continue
-            finally:
-                pass
-            if not response.get("error"):
-                success = 4
-            else:
-                success += 1;
-        if response.get("error"):
-            self.logger.debug("Error received from Facebook: {0}".format(response["error"]["message"]))
-            self.logger.error("Failed to retrieve {0} from Facebook.".format(path))
-            raise Exception(response["error"]["type"], response["error"]["message"])
-        return response
+        code = self.codes.get(user_id)
+        if code is None:
+            code = self.codes[user_id] = len(self.users)
+            self.users.append(user_id)
+        return code
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __getitem__(self, i):
+        like_start, like_end = self.like_offsets[i], self.like_offsets[i + 1]
+        comment_start, comment_end = self.comment_offsets[i], self.comment_offsets[i + 1]
+        return Post(self.ids[i], self.users[self.authors[i]], int(self.times[i]), int(self.sizes[i]),
+                    tuple(self.users[code] for code in self.like_users[like_start:like_end]),
+                    tuple(self.users[code] for code in self.comment_users[comment_start:comment_end]))
+    
+    def __iter__(self):
+        for i in xrange(len(self.ids)):
+            yield self[i]
+    
+    def _interacted(self, users, posts, user_id):
+        """
+        Get a mask of the posts a user appears in, for likes or comments.
+        
+        @param users: The liker or commenter codes
+        @type  users: C{numpy.ndarray}
+        @param posts: The post each liker or commenter belongs to
+        @type  posts: C{numpy.ndarray}
+        @param user_id: The user to look for
+        @type  user_id: C{str}
+        @return: A boolean mask over the posts
+        @rtype: C{numpy.ndarray}
+        """
+        mask = numpy.zeros(len(self.ids), dtype=bool)
+        code = self.codes.get(user_id)
+        if code is not None:
+            mask[posts[users == code]] = True
+        return mask
+    
+    def filter(self, time_start=None, time_end=None, author=None, liker=None, commenter=None, intersect=True):
+        """
+        Get the positions of the posts matching a wall_filter query.
+        
+        Takes the same arguments as L{WallIndex.filter}.
+        
+        @return: The sorted positions of the matching posts
+        @rtype: C{list} of C{int}
+        """
+        masks = []
+        if author is not None:
+            code = self.codes.get(author)
+            masks.append(self.authors == code if code is not None else numpy.zeros(len(self.ids), dtype=bool))
+        if liker is not None:
+            masks.append(self._interacted(self.like_users, self.like_posts, liker))
+        if commenter is not None:
+            masks.append(self._interacted(self.comment_users, self.comment_posts, commenter))
+        
+        if intersect:
+            mask = numpy.ones(len(self.ids), dtype=bool)
+            for person in masks:
+                mask &= person
+        else:
+            mask = numpy.zeros(len(self.ids), dtype=bool)
+            for person in masks:
+                mask |= person
+        if time_start is not None:
+            mask &= self.times > time_start
+        if time_end is not None:
+            mask &= self.times < time_end
+        return numpy.flatnonzero(mask).tolist()
+
 
 class User:
     """
@@ -170,12 +1793,31 @@ class User:
     """The keys that should be kept in wall posts
     @type: C{tuple}"""
     
-    def __init__(self, graph, logger, user_id, friend_data=1):
+    import_subfields = {'from': ('id', 'name'), 'likes': ('id', 'name'), 'comments': ('id', 'from')}
+    """The keys that should be kept in objects nested in wall posts
+    @type: C{dict}"""
+    
+    identity_fields = 'id', 'name'
+    """The keys that should be requested for users and friends
+    @type: C{tuple}"""
+    
+    lazy_attributes = 'me', 'identity', 'friends', 'wall', 'likes'
+    """The attributes a lazy user fetches the first time they are used
+    @type: C{tuple}"""
+    
+    registry = UserRegistry()
+    """The cache of users shared by all User objects in the process
+    @type: L{UserRegistry}"""
+    
+    def __init__(self, graph, logger, user_id, friend_data=1, batch=False, concurrency=1, max_posts=500, columnar=False,
+                 lazy=False):
         """
         Get all information about the user and process it.
         
         Get the user object, the user's friends, wall, and likes, remove unnecessary
-        properties, and process the wall posts.
+        properties, and process the wall posts. In lazy mode nothing is fetched
+        yet: each of me, identity, friends, wall, and likes is fetched the first
+        time it is used.
         
         @param graph: A GraphAPI object
         @type  graph: L{Graph}
@@ -183,44 +1825,179 @@ class User:
         @type  user_id: C{int}
         @param friend_data: 0 to ignore friends, 1 to get friend list, and 2 to recurse friends
         @type  friend_data: C{int}
+        @param batch: Whether to fetch the user (and each friend) in a single batch request
+        @type  batch: C{bool}
+        @param concurrency: The maximum number of friends to fetch at once when recursing friends
+        @type  concurrency: C{int}
+        @param max_posts: The maximum number of wall posts to get, or None for the full history
+        @type  max_posts: C{int}
+        @param columnar: Whether to store the wall in a L{ColumnarWall} rather than a list
+        @type  columnar: C{bool}
+        @param lazy: Whether to wait until each attribute is used before fetching it
+        @type  lazy: C{bool}
         """
         self.logger = logger
         self.graph = graph
+        self.user_id = user_id
+        self.options = {'friend_data': friend_data, 'batch': batch, 'concurrency': concurrency,
+                        'max_posts': max_posts, 'columnar': columnar}
+        if lazy:
+            self.logger.debug("Deferring retrieval of user {0} until it is needed.".format(user_id))
+            return
         self.logger.info("Retrieving data about user {0}.".format(user_id))
         # Get the user
-        self.me = graph.get_object(user_id)
+        me, friends, feed, likes = self.__fetch(user_id, friend_data, batch, max_posts)
+        self.__load_me(me)
+        self.__load_friends(friends)
+        self.__load_likes(likes)
+        self.__load_wall(feed)
+    
+    def __getattr__(self, name):
+        """
+        Fetch a lazily loaded attribute the first time it is used.
+        
+        @param name: The name of the attribute
+        @type  name: C{str}
+        @return: The attribute
+        @rtype: mixed
+        """
+        if name not in self.lazy_attributes or 'options' not in self.__dict__:
+            raise AttributeError(name)
+        if name in ('me', 'identity'):
+            self.__load_me(self.graph.get_object(self.user_id, fields=field_projection(self.identity_fields)))
+        elif name == 'friends':
+            self.__load_friends(self.__connection('friends') if self.options['friend_data'] else iter([]))
+        elif name == 'likes':
+            self.__load_likes(self.__connection('likes'))
+        else:
+            self.__load_wall(self.__connection('feed'))
+        return self.__dict__[name]
+    
+    def __load_me(self, me):
+        """
+        Store the user object and the user's identity.
+        
+        @param me: The user object from the Graph API
+        @type  me: C{dict}
+        """
+        self.me = me
+        self.identity = {'name': me['name'], 'id': me['id']}
+    
+    def __load_friends(self, friends):
+        """
+        Store the friend list, making a user object for each friend if recursing friends.
         
+        @param friends: The friends from the Graph API
+        @type  friends: iterable of C{dict}
+        """
+        friend_data = self.options['friend_data']
+        concurrency = self.options['concurrency']
         # If recurse_friends, make a user object for each friend, which in turn gets their
         # wall and likes.
         if friend_data == 2:
-            self.logger.info("Retrieving friend data from user {0}.".format(user_id))
-            self.friends = [User(graph, logger, friend['id'], 0) for friend in graph.get_connection(user_id, 'friends', limit=500).get('data', [])]
+            self.logger.info("Retrieving friend data from user {0}.".format(self.user_id))
+            make_friend = lambda friend: self.registry.get(self.graph, self.logger, friend['id'],
+                                                           batch=self.options['batch'],
+                                                           max_posts=self.options['max_posts'],
+                                                           columnar=self.options['columnar'])
+            if concurrency > 1:
+                # Map preserves the order of the friend list.
+                pool = ThreadPool(concurrency)
+                try:
+                    self.friends = pool.map(make_friend, friends)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                self.friends = map(make_friend, friends)
         elif friend_data == 1:
-            self.logger.debug("Getting friend list from user {0}.".format(user_id))
-            self.friends = graph.get_connection(user_id, 'friends', limit=500).get('data', [])
+            self.friends = list(friends)
         else:
             self.friends = []
+    
+    def __load_likes(self, likes):
+        """
+        Store the user's likes, only keeping their IDs.
+        
+        @param likes: The likes from the Graph API
+        @type  likes: iterable of C{dict}
+        """
+        self.likes = frozenset(intern_like(like['id']) for like in likes)
+    
+    def __load_wall(self, feed):
+        """
+        Store the user's wall, converted into compact posts.
+        
+        @param feed: The wall posts from the Graph API
+        @type  feed: iterable of C{dict}
+        """
+        self.logger.debug("Processing wall posts from user {0}.".format(self.user_id))
+        if self.options['columnar']:
+            self.wall = ColumnarWall(Post.from_graph(post) for post in feed)
+        else:
+            self.wall = [Post.from_graph(post) for post in feed]
+    
+    def __connection(self, name):
+        """
+        Stream one of the user's connections, only requesting the fields that are kept.
+        
+        @param name: One of 'friends', 'feed', or 'likes'
+        @type  name: C{str}
+        @return: An iterator over the connection
+        @rtype: C{generator}
+        """
+        if name == 'friends':
+            self.logger.debug("Getting friend list from user {0}.".format(self.user_id))
+            return self.graph.iter_connection(self.user_id, 'friends', limit=500,
+                                              fields=field_projection(self.identity_fields))
+        elif name == 'feed':
+            self.logger.debug("Getting wall data from user {0}.".format(self.user_id))
+            return self.graph.iter_connection(self.user_id, 'feed', max_items=self.options['max_posts'], limit=500,
+                                              fields=field_projection(self.import_fields, self.import_subfields))
+        else:
+            self.logger.debug("Getting likes and activities from user {0}.".format(self.user_id))
+            return self.graph.iter_connection(self.user_id, 'likes', fields='id')
+    
+    def __fetch(self, user_id, friend_data, batch, max_posts):
+        """
+        Get the user object, friend list, wall, and likes from the graph.
+        
+        This is an internal and private function. In batch mode the first page
+        of each connection is sent to Facebook in a single round trip. The
+        connections are returned as streams that fetch further pages lazily.
         
-        # Get the user's wall and likes. Filter the wall to only get the fields we need
-        # and only keep the IDs from the likes
-        self.logger.debug("Getting wall data from user {0}.".format(user_id))
-        raw_wall = [dict([(key, value) for key, value in post.iteritems() if key in self.import_fields])
-                     for post in graph.get_connection(user_id, 'feed', limit=500).get('data', [])]
-        self.logger.debug("Getting likes and activities from user {0}.".format(user_id))
-        self.likes = [like['id'] for like in graph.get_connection(user_id, 'likes').get('data', [])]
-        
-        # Convert created_time into datetime
-        self.logger.debug("Processing wall posts from user {0}.".format(user_id))
-        wall = []
-        for post in raw_wall:
-            post['created_time'] = datetime.datetime.strptime(post['created_time'][:-5], "%Y-%m-%dT%H:%M:%S")
-            post['to'] = {'name': self.me['name'], 'id': user_id}
-            post['likes'] = post.get('likes', {'data': []})
-            post['comments'] = post.get('comments', {'data': []})
-            wall.append(post)
-        self.wall = wall
-        
-        self.identity = {'name': self.me['name'], 'id': self.me['id']}
+        @param user_id: ID of the user
+        @type  user_id: C{int}
+        @param friend_data: 0 to skip the friend list, otherwise fetch it
+        @type  friend_data: C{int}
+        @param batch: Whether to use a batch request
+        @type  batch: C{bool}
+        @param max_posts: The maximum number of wall posts to get, or None for all
+        @type  max_posts: C{int}
+        @return: The user object and iterators over the friends, wall posts, and likes
+        @rtype: C{tuple}
+        """
+        if not batch:
+            me = self.graph.get_object(user_id, fields=field_projection(self.identity_fields))
+            friends = self.__connection('friends') if friend_data else iter([])
+            return me, friends, self.__connection('feed'), self.__connection('likes')
+        
+        # Only request the fields that are kept.
+        identity_fields = field_projection(self.identity_fields)
+        wall_fields = field_projection(self.import_fields, self.import_subfields)
+        self.logger.debug("Getting user, wall, and likes of user {0} in one batch.".format(user_id))
+        requests = self.graph.batch()
+        requests.get_object(user_id, fields=identity_fields)
+        requests.get_connection(user_id, 'feed', limit=500, fields=wall_fields)
+        requests.get_connection(user_id, 'likes', fields='id')
+        if friend_data:
+            requests.get_connection(user_id, 'friends', limit=500, fields=identity_fields)
+        responses = requests.execute()
+        me = responses[0]
+        feed = self.graph.iter_pages(responses[1], max_posts)
+        likes = self.graph.iter_pages(responses[2])
+        friends = self.graph.iter_pages(responses[3]) if friend_data else iter([])
+        return me, friends, feed, likes
     
     def intersect(self, friend):
         """
@@ -232,26 +2009,142 @@ class User:
         @rtype: C{list}
         """
         self.logger.debug("Creating likes intersect with user {0} and {1}.".format(self.identity['id'], friend.identity['id']))
-        likes1 = self.likes
-        likes2 = friend.likes
-        return list(set(likes1) & set(likes2))
+        return list(self.likes & friend.likes)
+    
+    def common_likes(self, others):
+        """
+        Count how many likes the user has in common with each of several users.
+        
+        Likes are stored as frozensets, so each count is a single intersection
+        that only walks the smaller of the two sets.
+        
+        @param others: The users to compare to
+        @type  others: iterable of L{User}
+        @return: The number of common likes with each user, in order
+        @rtype: C{list} of C{int}
+        """
+        likes = self.likes
+        return [len(likes & other.likes) for other in others]
+    
+    def is_important(self, post):
+        """
+        Determine whether a post is important to the user.
+        
+        A post is important if the user wrote it, liked it, or commented on it.
+        
+        @param post: The post
+        @type  post: L{Post}
+        @return: Whether the post is important
+        @rtype: C{bool}
+        """
+        user_id = self.identity['id']
+        return post.author == user_id or user_id in post.likers or user_id in post.commenters
     
-    def wall_sample(self, n):
+    def wall_sample(self, n, seed=None, stratify=False, walls=None):
         """
-        Generate a sample of n posts from the user's wall and the user's friends' walls.
+        Generate a sample of n posts from the user's friends' walls.
+        
+        The walls are streamed through a reservoir sampler, so they are never
+        combined into one list. If there are fewer than n posts, all of them
+        are returned.
         
         @param n: The number of posts to retrieve
         @type  n: C{int}
+        @param seed: Seed for a reproducible sample, or None to use the global random generator
+        @type  seed: C{int}
+        @param stratify: Whether to take half of the sample from important posts and half from the rest
+        @type  stratify: C{bool}
+        @param walls: The walls to sample from instead of the friends' walls, e.g. lazily paged feeds
+        @type  walls: iterable of iterables of L{Post}
         @return: A list of posts
         @rtype: C{list}
         """
-        self.logger.debug("Generating {0} post wall sample for user {0}.".format(n, self.identity['id']))
-        posts = []
-        for friend in self.friends:
-            map(posts.append, friend.wall)
+        self.logger.debug("Generating {0} post wall sample for user {1}.".format(n, self.identity['id']))
+        rand = random.Random(seed) if seed is not None else random
+        if walls is None:
+            walls = (friend.wall for friend in self.friends)
+        posts = itertools.chain.from_iterable(walls)
+        if not stratify:
+            return reservoir_sample(posts, n, rand)
+        
+        # Keep a reservoir for each label.
+        important = []
+        other = []
+        seen = [0, 0]
+        for post in posts:
+            label = int(self.is_important(post))
+            sample, size = (important, n // 2) if label else (other, n - n // 2)
+            if seen[label] < size:
+                sample.append(post)
+            else:
+                j = rand.randint(0, seen[label])
+                if j < size:
+                    sample[j] = post
+            seen[label] += 1
+        return important + other
+    
+
+    def wall_index(self):
+        """
+        Get the index of the user's wall, building it the first time it is needed.
+        
+        A columnar wall answers queries itself and is its own index.
+        
+        @return: The wall index
+        @rtype: L{WallIndex} or L{ColumnarWall}
+        """
+        if isinstance(self.wall, ColumnarWall):
+            return self.wall
+        if getattr(self, '_wall_index', None) is None:
+            self.logger.debug("Indexing wall posts from user {0}.".format(self.identity['id']))
+            self._wall_index = WallIndex(self.wall)
+        return self._wall_index
+    
+    def interactions_from(self, other):
+        """
+        Get when another user liked or commented on posts this user wrote on their own wall.
+        
+        The timeline has an entry for each like and each comment, at the time
+        of the post. It is built the first time it is needed for each user.
+        
+        @param other: The user who interacted
+        @type  other: L{User}
+        @return: The interaction timeline
+        @rtype: L{InteractionTimeline}
+        """
+        if getattr(self, '_interactions', None) is None:
+            self._interactions = {}
+        timeline = self._interactions.get(other.identity['id'])
+        if timeline is None:
+            liked = self.wall_filter(author=self, liked_by=other)
+            commented = self.wall_filter(author=self, commented_by=other)
+            timeline = InteractionTimeline(post.created_time for post in liked + commented)
+            self._interactions[other.identity['id']] = timeline
+        return timeline
+    
+    def conversation_with(self, other):
+        """
+        Get when this user and another user interacted on either of their walls.
         
-        return random.sample(posts, n)
+        The timeline merges the posts on this user's wall that the other user
+        wrote or commented on with the posts on the other user's wall that this
+        user wrote or commented on. It is built the first time it is needed for
+        each user.
         
+        @param other: The other user
+        @type  other: L{User}
+        @return: The interaction timeline
+        @rtype: L{InteractionTimeline}
+        """
+        if getattr(self, '_conversations', None) is None:
+            self._conversations = {}
+        timeline = self._conversations.get(other.identity['id'])
+        if timeline is None:
+            mine = self.wall_filter(author=other, commented_by=other, intersect=False)
+            theirs = other.wall_filter(author=self, commented_by=self, intersect=False)
+            timeline = InteractionTimeline(post.created_time for post in mine + theirs)
+            self._conversations[other.identity['id']] = timeline
+        return timeline
     
     def wall_filter(self, time_start=False, time_end=False, author=False, liked_by=False, commented_by=False, intersect=True):
         """
@@ -263,17 +2156,20 @@ class User:
         filter is turned on.
         
         @param time_start: Only show posts after this time
-        @type  time_start: datetime.datetime
+        @type  time_start: datetime.datetime or seconds since the epoch
         @param time_end: Only show posts before this time
-        @type  time_end: datetime.datetime
+        @type  time_end: datetime.datetime or seconds since the epoch
         @param author: Only show posts made by this user (name and id)
         @type  author: C{dict}
         @param liked_by: Only show posts made liked by this user (name and id)
         @type  liked_by: C{dict}
         @param commented_by: Only show posts made commented on by this user (name and id)
         @type  commented_by: C{dict}
+        @param intersect: Whether posts must match all of the author, liked_by, and commented_by
+                          filters, rather than any of them
+        @type  intersect: C{bool}
         
-        @return: List of matching posts
+        @return: List of matching posts, in wall order
         @rtype: C{list}
         """
         # Make user-readable log entry representing this filter.
@@ -294,146 +2190,144 @@ class User:
             logging_string += " commented by " + commented_by.identity['id'] + ";"
         self.logger.debug(logging_string)
 
-	def unique_posts(posts):
-            found = set()
-            for post in posts:
-                if not post.get('id', False):
-                    raise Exception(post)
-                if post['id'] not in found:
-                    yield post
-                    found.add(post['id'])
-        
-        def list_intersection(*args):
-            final = []
-            if len(args) == 0:
-                return []
-            for item in args[0]:
-                for list in args[1:]:
-                    if item not in list:
-                        continue
-                final.append(item)
-            return final
-        
-        # Start filtering
-        posts = self.wall
-
-        if intersect:
-            default = posts
-        else:
-            default = []
-            
-        if isinstance(time_start, datetime.datetime):
-            posts = [post for post in posts if post['created_time'] > time_start]
-        if isinstance(time_end, datetime.datetime):
-            posts = [post for post in posts if post['created_time'] < time_end]
-        
-        if isinstance(author, User):
-            posts1 = list(unique_posts([post for post in posts if post['from'] == author.identity]))
-        else:
-            posts1 = default
-
-        if isinstance(liked_by, User):
-            posts2 = list(unique_posts([post for post in posts if [like for like in post['likes'].get('data', []) if like == liked_by.identity]]))
-        else:
-            posts2 = default
-
-        if isinstance(commented_by, User):
-            posts3 = list(unique_posts([post for post in posts if [comm for comm in post['comments'].get('data', []) if comm['from'] == commented_by.identity]]))
-        else:
-            posts3 = default
+        positions = self.wall_index().filter(
+            to_epoch(time_start) if time_start is not False else None,
+            to_epoch(time_end) if time_end is not False else None,
+            author.identity['id'] if isinstance(author, User) else None,
+            liked_by.identity['id'] if isinstance(liked_by, User) else None,
+            commented_by.identity['id'] if isinstance(commented_by, User) else None,
+            intersect)
         
-        if intersect:
-            return list_intersection(posts, posts1, posts2, posts3)
-        else:
-            return list(unique_posts(posts1 + posts2 + posts3))
+        # Return posts in wall order, without duplicates.
+        found = set()
+        posts = []
+        for i in positions:
+            post = self.wall[i]
+            if post.id not in found:
+                found.add(post.id)
+                posts.append(post)
+        return posts
 
-    def make_training_data(self):
+    def make_training_data(self, n=1000, seed=None, stratify=False, window=None):
         """
         Creates a set of training data for the support vector machine.
         
-        Creates a sample of posts, uses an internal function to gather data
-        from each post, then return the dataset. The length of each post,
-        the number of likes the user and author have in common, the time since
-        the author and user last communicated, the number of user posts the
-        author liked or commented on, and vice-versa are the data that is
-        collected.
+        Creates a sample of posts, uses a L{FeatureEngine} to gather data
+        from all of the posts at once, then return the dataset. The length of
+        each post, the number of likes the user and author have in common, the
+        time since the author and user last communicated, the number of user
+        posts the author liked or commented on, and vice-versa are the data
+        that is collected.
         
+        @param n: The number of posts to sample
+        @type  n: C{int}
+        @param seed: Seed for a reproducible sample
+        @type  seed: C{int}
+        @param stratify: Whether to balance the sample between important and other posts
+        @type  stratify: C{bool}
+        @param window: How far back, in seconds, to count interactions, or None for L{FeatureEngine.window}
+        @type  window: C{int}
         @return: A list of tuples with an importance indicator and a tuple of data
         @rtype: C{list} of C{tuple} with C{str} and C{tuple}
         """
-        posts = self.wall_sample(1000)
-        training_data = []
-        data = map(self.__fitness_internal, posts)
-        return data
-
-    def __fitness_internal(self, post):
+        posts = self.wall_sample(n, seed, stratify)
+        return self.feature_engine(window).features(posts)
+    
+    def feature_engine(self, window=None):
         """
-        Takes an individual post and gathers the necessary data to
-        give to the support vector machine.
+        Get the feature engine for the user, creating it the first time it is needed.
         
-        This is an internal and private function.The length of each post,
-        the number of likes the user and author have in common, the time since
-        the author and user last communicated, the number of user posts the
-        author liked or commented on, and vice-versa are the data that is
-        collected.
+        The engine remembers what it has computed for each author, so later
+        batches of posts by the same authors are cheaper. Asking for a
+        different window replaces it with a new engine.
         
-        @param post: A post directly from the Graph API to evaluate
-        @return: Whether the post is important and a tuple of parameters
-        @rtype: C{tuple} of C{str} and a C{tuple}
+        @param window: How far back, in seconds, to count interactions, or None for L{FeatureEngine.window}
+        @type  window: C{int}
+        @return: The feature engine
+        @rtype: L{FeatureEngine}
         """
-        # If the user is the author, if the user liked it, or if the user commented, it is important.
-        if post['from'] == self.identity or self.identity in post['likes'].get('data', []) or\
-                       [comm for comm in post['comments'].get('data', []) if comm['from'] == self.identity]:
-            important = True
-        else:
-            important = False
-    
-        # Get the author and number of words
-        author = User(self.graph, self.logger, post['from']['id'], 0)
-        size = len(post.get('message', '').split())
-    
-        # Find out how long since the two users last interacted.
-        if author.identity != self.identity:
-            # For each wall, filter posts that the other person either wrote or commented on.
-            wall_me = self.wall_filter(time_end=post['created_time'], author=author, commented_by=author, intersect=False)
-            wall_you = author.wall_filter(time_end=post['created_time'], author=self, commented_by=self, intersect=False)
-        
-            # Sort and get the earliest from each.
-            wall_me = sorted(wall_me, key=operator.itemgetter('created_time'))
-            wall_you = sorted(wall_you, key=operator.itemgetter('created_time'))
-            if len(wall_me) > 0:
-                first_me = wall_me[0]
-            else:
-                first_me = {'created_time': datetime.datetime(1970, 1, 1, 0, 0, 0)}
-            if len(wall_you) > 0:
-                first_you = wall_you[0]
-            else:
-                first_you = {'created_time': datetime.datetime(1970, 1, 1, 0, 0, 0)}
-        
-            # Find which one is the earliest and calculate the time difference.
-            if first_me['created_time'] > first_you['created_time']:
-                last_post = first_me
-            else:
-                last_post = first_you
-        
-            time_diff = post['created_time'] - last_post['created_time']
-        else:
-            # The author is the user, thus the last interaction time is 0.
-            time_diff = 0
+        engine = getattr(self, '_feature_engine', None)
+        if engine is None or engine.window != (window if window is not None else FeatureEngine.window):
+            engine = self._feature_engine = FeatureEngine(self, window)
+        return engine
+
+
+class FeatureEngine(object):
+    """
+    Gathers the data the support vector machine needs for many posts at once.
     
-        # Find how many of the author's posts the user liked or commented on in past three days
-        three_days_ago = post['created_time'] - datetime.timedelta(3)
-        posts_user_liked = author.wall_filter(time_start=three_days_ago, time_end=post['created_time'], author=author, liked_by=self)
-        posts_user_commented = author.wall_filter(time_start=three_days_ago, time_end=post['created_time'], author=author, commented_by=self)
-        interact_me2you = len(posts_user_liked) + len(posts_user_commented)
+    Posts are grouped by author. For each author, the interactions between
+    the author and the user are looked up once as timelines, and every post
+    by that author is answered from them instead of filtering both walls
+    again for each post.
+    """
     
-        # Find how many of the user's posts the author liked or commented on in past three days
-        posts_author_liked = self.wall_filter(time_start=three_days_ago, time_end=post['created_time'], author=self, liked_by=author)
-        posts_author_commented = self.wall_filter(time_start=three_days_ago, time_end=post['created_time'], author=self, commented_by=author)
-        interact_you2me = len(posts_author_liked) + len(posts_author_commented)
+    window = 3 * 86400
+    """How far back, in seconds, interactions are counted
+    @type: C{int}"""
     
-        # Check which likes the user and author have in common
-        common_likes = len(self.intersect(author))
+    def __init__(self, user, window=None):
+        """
+        Create an engine for a user.
+        
+        @param user: The user the posts are being evaluated for
+        @type  user: L{User}
+        @param window: How far back, in seconds, to count interactions, if not the default
+        @type  window: C{int}
+        """
+        self.user = user
+        if window is not None:
+            self.window = window
+        self._common_likes = {}
     
-        # Finally, add the data onto the training set
-        return int(important), (size, time_diff.total_seconds(), interact_me2you, interact_you2me, common_likes)
+    def features(self, posts):
+        """
+        Gather the data for each post.
+        
+        @param posts: The posts to evaluate
+        @type  posts: C{list} of L{Post}
+        @return: Whether each post is important and a tuple of parameters, in the order of posts
+        @rtype: C{list} of C{tuple} with C{int} and C{tuple}
+        """
+        user = self.user
+        user_id = user.identity['id']
+        by_author = {}
+        for i, post in enumerate(posts):
+            by_author.setdefault(post.author, []).append(i)
+        
+        groups = by_author.items()
+        # Look authors up with the options the user's friends were loaded with, so friends are found in the registry.
+        options = user.options
+        authors = [user if author_id == user_id else
+                   user.registry.get(user.graph, user.logger, author_id, batch=options['batch'],
+                                     max_posts=options['max_posts'], columnar=options['columnar'])
+                   for author_id, positions in groups]
+        
+        # Check which likes the user and each author have in common, once per author
+        counted = self._common_likes
+        missing = [(author_id, author) for (author_id, positions), author in zip(groups, authors) if author_id not in counted]
+        counted.update(zip([author_id for author_id, author in missing],
+                           user.common_likes([author for author_id, author in missing])))
+        common = [counted[author_id] for author_id, positions in groups]
+        
+        results = [None] * len(posts)
+        for author, positions, common_likes in zip(authors, [positions for author_id, positions in groups], common):
+            # Posts either person wrote or commented on, on the other's wall.
+            conversation = user.conversation_with(author) if author is not user else None
+            
+            # How often the user liked or commented on the author's posts, and vice-versa.
+            me2you = author.interactions_from(user)
+            you2me = user.interactions_from(author)
+            
+            for i in positions:
+                post = posts[i]
+                important = user.is_important(post)
+                # Find out how long since the two users last interacted.
+                if conversation is not None:
+                    time_diff = post.created_time - (conversation.last_before(post.created_time) or 0)
+                else:
+                    # The author is the user, thus the last interaction time is 0.
+                    time_diff = 0
+                results[i] = int(important), (post.size, float(time_diff), me2you.window(post.created_time, self.window),
+                                              you2me.window(post.created_time, self.window), common_likes)
+        return results
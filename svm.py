@@ -0,0 +1,1168 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Support vector machine training for the data collected by tasks.gather_data.
+
+Each collected file holds a JSON list of C{(important, features)} pairs, as
+returned by L{facebook.User.make_training_data}. The features are scaled to
+zero mean and unit variance and a linear SVM is trained on them. Train on
+every collected file with::
+
+    python svm.py /var/www/facebook/userdata/*
+
+Pass C{--kernel rbf} or C{--kernel poly} to train a kernel SVM instead, and
+C{--save} to keep the model for L{score_posts}.
+"""
+
+import sys
+import time
+import pickle
+import logging
+import optparse
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.sharedctypes
+
+import numpy
+
+import facebook
+
+
+def read_file(path, json):
+    """
+    Read one file of collected training data.
+
+    @param path: A file written by tasks.gather_data
+    @type  path: C{str}
+    @param json: The JSON parser to use
+    @type  json: C{function}
+    @return: The features, one row per post, and the labels, +1 for important posts and -1 otherwise
+    @rtype: C{tuple} of C{numpy.ndarray}
+    """
+    with open(path, 'rb') as fp:
+        rows = json(fp.read())
+    labels = numpy.array([1.0 if important else -1.0 for important, row in rows], dtype=numpy.float64)
+    features = numpy.array([row for important, row in rows], dtype=numpy.float64).reshape(-1, 5)
+    return features, labels
+
+
+def load_dataset(paths, json=None):
+    """
+    Load collected training data into a feature matrix and a label vector.
+
+    The files are read in sorted order, so the same files always give the
+    same rows regardless of the order they are listed in.
+
+    @param paths: The files written by tasks.gather_data
+    @type  paths: C{list} of C{str}
+    @param json: The JSON parser to use, or None to find one
+    @type  json: C{function}
+    @return: The features, one row per post, and the labels, +1 for important posts and -1 otherwise
+    @rtype: C{tuple} of C{numpy.ndarray}
+    """
+    if json is None:
+        json = facebook.find_json(logging.getLogger('facebook-research'))
+    data = [read_file(path, json) for path in sorted(paths)]
+    if not data:
+        return numpy.zeros((0, 5)), numpy.zeros(0)
+    return numpy.vstack([X for X, y in data]), numpy.concatenate([y for X, y in data])
+
+
+def iter_chunks(paths, chunk_size=4096, json=None):
+    """
+    Stream collected training data in chunks of a fixed size.
+
+    Only one file and one chunk are held in memory at a time, so memory use
+    does not grow with the number of files. Each file holds the training
+    data for a single user, which make_training_data keeps small.
+
+    @param paths: The files written by tasks.gather_data, in the order to read them
+    @type  paths: C{list} of C{str}
+    @param chunk_size: The number of posts in each chunk; the last chunk may be smaller
+    @type  chunk_size: C{int}
+    @param json: The JSON parser to use, or None to find one
+    @type  json: C{function}
+    @return: The features and labels of each chunk
+    @rtype: C{generator} of C{tuple} of C{numpy.ndarray}
+    """
+    if json is None:
+        json = facebook.find_json(logging.getLogger('facebook-research'))
+    features = []
+    labels = []
+    buffered = 0
+    for path in paths:
+        X, y = read_file(path, json)
+        features.append(X)
+        labels.append(y)
+        buffered += len(y)
+        while buffered >= chunk_size:
+            X = numpy.vstack(features)
+            y = numpy.concatenate(labels)
+            yield X[:chunk_size], y[:chunk_size]
+            features, labels = [X[chunk_size:]], [y[chunk_size:]]
+            buffered -= chunk_size
+    if buffered:
+        yield numpy.vstack(features), numpy.concatenate(labels)
+
+
+class Scaler(object):
+    """
+    Scales features to zero mean and unit variance.
+    """
+
+    def __init__(self):
+        """
+        Create an unfitted scaler.
+        """
+        self.count = 0
+        self.mean = None
+        self.scale = None
+        self._squares = None
+
+    def fit(self, X):
+        """
+        Compute the mean and standard deviation of each feature.
+
+        @param X: The features, one row per sample
+        @type  X: C{numpy.ndarray}
+        @return: The scaler
+        @rtype: L{Scaler}
+        """
+        self.count = 0
+        return self.partial_fit(X)
+
+    def partial_fit(self, X):
+        """
+        Update the mean and standard deviation with another chunk of samples.
+
+        The statistics of the chunk are merged with the running ones using
+        the pairwise update of Chan et al., which stays accurate over many
+        chunks, unlike accumulating sums of squares.
+
+        @param X: The features, one row per sample
+        @type  X: C{numpy.ndarray}
+        @return: The scaler
+        @rtype: L{Scaler}
+        """
+        if not len(X):
+            return self
+        count = X.shape[0]
+        mean = X.mean(axis=0)
+        squares = ((X - mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.mean = mean
+            self._squares = squares
+        else:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * count / total
+            self._squares = self._squares + squares + delta ** 2 * self.count * count / total
+        self.count += count
+        self.scale = numpy.sqrt(self._squares / self.count)
+        self.scale[self.scale == 0] = 1.0
+        return self
+
+    def transform(self, X):
+        """
+        Scale features.
+
+        @param X: The features, one row per sample
+        @type  X: C{numpy.ndarray}
+        @return: The scaled features
+        @rtype: C{numpy.ndarray}
+        """
+        return (X - self.mean) / self.scale
+
+
+class Classifier(object):
+    """
+    Base class for classifiers that predict from a decision function.
+
+    Subclasses define decision_function.
+    """
+
+    def predict(self, X):
+        """
+        Predict the label of each sample.
+
+        @param X: The scaled features
+        @type  X: C{numpy.ndarray}
+        @return: The labels, +1 or -1
+        @rtype: C{numpy.ndarray}
+        """
+        return numpy.where(self.decision_function(X) >= 0, 1.0, -1.0)
+
+    def score(self, X, y):
+        """
+        Get the accuracy of the classifier.
+
+        @param X: The scaled features
+        @type  X: C{numpy.ndarray}
+        @param y: The true labels
+        @type  y: C{numpy.ndarray}
+        @return: The fraction of samples predicted correctly
+        @rtype: C{float}
+        """
+        return float((self.predict(X) == y).mean()) if len(y) else 0.0
+
+
+class LinearSVM(Classifier):
+    """
+    A linear support vector machine trained with mini-batch Pegasos.
+
+    Each step takes a random mini-batch, finds the samples violating the
+    margin with one matrix product, and moves the weights towards them with
+    a step size of 1 / (lambda * t). The bias is learned as the weight of an
+    extra constant feature. Predictions use a running average of the weights
+    that favours recent steps, which is much less noisy than the weights
+    after the last step.
+    """
+
+    def __init__(self, C=1.0, epochs=20, batch_size=64, seed=0):
+        """
+        Create an untrained SVM.
+
+        @param C: The penalty for margin violations; larger values fit the data more closely
+        @type  C: C{float}
+        @param epochs: The number of passes over the training data
+        @type  epochs: C{int}
+        @param batch_size: The number of samples in each mini-batch
+        @type  batch_size: C{int}
+        @param seed: Seed for the random generator, for reproducible training
+        @type  seed: C{int}
+        """
+        self.C = C
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.seed = seed
+        self.weights = None
+        self.average = None
+        self.steps = 0
+
+    def _augment(self, X):
+        """
+        Add the constant bias feature.
+
+        @param X: The features
+        @type  X: C{numpy.ndarray}
+        @return: The features with a column of ones appended
+        @rtype: C{numpy.ndarray}
+        """
+        return numpy.hstack([X, numpy.ones((X.shape[0], 1))])
+
+    def fit(self, X, y):
+        """
+        Train the SVM from scratch.
+
+        @param X: The scaled features, one row per sample
+        @type  X: C{numpy.ndarray}
+        @param y: The labels, +1 or -1
+        @type  y: C{numpy.ndarray}
+        @return: The SVM
+        @rtype: L{LinearSVM}
+        """
+        self.weights = None
+        self.average = None
+        self.steps = 0
+        rand = numpy.random.RandomState(self.seed)
+        for epoch in range(self.epochs):
+            order = rand.permutation(X.shape[0])
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                self.partial_fit(X[batch], y[batch], X.shape[0])
+        return self
+
+    def partial_fit(self, X, y, n_samples=None):
+        """
+        Take a single Pegasos step on a mini-batch.
+
+        The regularization strength is 1 / (C * n_samples), which makes the
+        Pegasos objective match the usual SVM objective with penalty C.
+
+        @param X: The scaled features of the mini-batch
+        @type  X: C{numpy.ndarray}
+        @param y: The labels of the mini-batch
+        @type  y: C{numpy.ndarray}
+        @param n_samples: The size of the whole training set, or None to use the size of the mini-batch
+        @type  n_samples: C{int}
+        @return: The SVM
+        @rtype: L{LinearSVM}
+        """
+        X = self._augment(X)
+        if self.weights is None:
+            self.weights = numpy.zeros(X.shape[1])
+            self.average = numpy.zeros(X.shape[1])
+        lam = 1.0 / (self.C * max(n_samples or X.shape[0], 1))
+        self.steps += 1
+        eta = 1.0 / (lam * self.steps)
+        violated = y * X.dot(self.weights) < 1
+        self.weights *= 1 - eta * lam
+        if violated.any():
+            self.weights += eta / X.shape[0] * (y[violated][:, None] * X[violated]).sum(axis=0)
+        # Project back onto the ball that contains the optimum.
+        norm = numpy.sqrt(self.weights.dot(self.weights))
+        if norm > 1 / numpy.sqrt(lam):
+            self.weights *= 1 / (numpy.sqrt(lam) * norm)
+        # Polynomial-decay averaging (Shamir and Zhang, 2013).
+        self.average += 4.0 / (self.steps + 3) * (self.weights - self.average)
+        return self
+
+    def decision_function(self, X):
+        """
+        Get the signed distance of each sample from the separating hyperplane.
+
+        @param X: The scaled features
+        @type  X: C{numpy.ndarray}
+        @return: The decision values
+        @rtype: C{numpy.ndarray}
+        """
+        return self._augment(X).dot(self.average)
+
+
+def rbf_kernel(X, Z, gamma):
+    """
+    Compute the Gaussian kernel exp(-gamma * |x - z|^2) between two sets of samples.
+
+    @param X: The first samples, one per row
+    @type  X: C{numpy.ndarray}
+    @param Z: The second samples, one per row
+    @type  Z: C{numpy.ndarray}
+    @param gamma: The kernel width
+    @type  gamma: C{float}
+    @return: The kernel matrix, with a row for each sample in X
+    @rtype: C{numpy.ndarray}
+    """
+    distances = (X ** 2).sum(axis=1)[:, None] + (Z ** 2).sum(axis=1)[None, :] - 2 * X.dot(Z.T)
+    return numpy.exp(-gamma * numpy.maximum(distances, 0))
+
+
+def polynomial_kernel(X, Z, gamma, degree, coef0):
+    """
+    Compute the polynomial kernel (gamma * x.z + coef0)^degree between two sets of samples.
+
+    @param X: The first samples, one per row
+    @type  X: C{numpy.ndarray}
+    @param Z: The second samples, one per row
+    @type  Z: C{numpy.ndarray}
+    @param gamma: The scale of the dot product
+    @type  gamma: C{float}
+    @param degree: The degree of the polynomial
+    @type  degree: C{int}
+    @param coef0: The constant term
+    @type  coef0: C{float}
+    @return: The kernel matrix, with a row for each sample in X
+    @rtype: C{numpy.ndarray}
+    """
+    return (gamma * X.dot(Z.T) + coef0) ** degree
+
+
+class KernelCache(object):
+    """
+    A memory-bounded cache of rows of the kernel matrix.
+
+    SMO only needs two rows of the kernel matrix per step, and tends to use
+    the same rows repeatedly, so rows are computed on demand and kept until
+    the cache is full, when the least recently used row is evicted. The full
+    matrix is never built.
+    """
+
+    def __init__(self, X, kernel, size=100):
+        """
+        Create an empty cache.
+
+        @param X: The training samples
+        @type  X: C{numpy.ndarray}
+        @param kernel: Function computing the kernel matrix between two sets of samples
+        @type  kernel: C{function}
+        @param size: The maximum size of the cache in megabytes; at least two rows are always kept
+        @type  size: C{float}
+        """
+        self.X = X
+        self.kernel = kernel
+        self.rows = max(2, int(size * 1024 * 1024 / (X.itemsize * max(len(X), 1))))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rows = collections.OrderedDict()
+
+    def row(self, i):
+        """
+        Get the kernel values between one sample and every sample.
+
+        @param i: The index of the sample
+        @type  i: C{int}
+        @return: The row of the kernel matrix
+        @rtype: C{numpy.ndarray}
+        """
+        row = self._rows.pop(i, None)
+        if row is not None:
+            self._rows[i] = row
+            self.hits += 1
+            return row
+        self.misses += 1
+        row = self.kernel(self.X, self.X[i:i + 1])[:, 0]
+        self._rows[i] = row
+        while len(self._rows) > self.rows:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+        return row
+
+    def stats(self):
+        """
+        Get the cache hit, miss, and eviction counters.
+
+        @return: The counters, the hit rate, and the number of cached rows
+        @rtype: C{dict}
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': float(self.hits) / total if total else 0.0, 'size': len(self._rows)}
+
+
+class KernelSVM(Classifier):
+    """
+    A kernel support vector machine trained with SMO.
+
+    Each step of sequential minimal optimization updates the two dual
+    variables that violate the optimality conditions most, chosen with the
+    second order working set selection of Fan, Chen and Lin (2005) used by
+    LIBSVM. Kernel rows come from a L{KernelCache}.
+    """
+
+    kernels = ('rbf', 'poly')
+
+    def __init__(self, kernel='rbf', C=1.0, gamma=None, degree=3, coef0=1.0, tol=1e-3, max_iter=100000, cache_size=100,
+                 class_weight=None):
+        """
+        Create an untrained SVM.
+
+        @param kernel: The kernel to use, C{'rbf'} or C{'poly'}
+        @type  kernel: C{str}
+        @param C: The penalty for margin violations; larger values fit the data more closely
+        @type  C: C{float}
+        @param gamma: The kernel coefficient, or None for one over the number of features
+        @type  gamma: C{float}
+        @param degree: The degree of the polynomial kernel
+        @type  degree: C{int}
+        @param coef0: The constant term of the polynomial kernel
+        @type  coef0: C{float}
+        @param tol: Stop when the largest violation of the optimality conditions is below this
+        @type  tol: C{float}
+        @param max_iter: The maximum number of SMO steps
+        @type  max_iter: C{int}
+        @param cache_size: The size of the kernel row cache in megabytes
+        @type  cache_size: C{float}
+        @param class_weight: Multipliers of C for each label, C{'balanced'} to weight labels inversely to their frequency, or None
+        @type  class_weight: C{dict} or C{str}
+        """
+        if kernel not in self.kernels:
+            raise ValueError("Unknown kernel: {0}".format(kernel))
+        self.kernel = kernel
+        self.C = C
+        self.gamma = gamma
+        self.degree = degree
+        self.coef0 = coef0
+        self.tol = tol
+        self.max_iter = max_iter
+        self.cache_size = cache_size
+        self.class_weight = class_weight
+        self.alpha = None
+        self.support_vectors = None
+        self.dual_coef = None
+        self.rho = 0.0
+        self.iterations = 0
+        self.cache_stats = None
+
+    def kernel_matrix(self, X, Z):
+        """
+        Compute the kernel between two sets of samples.
+
+        @param X: The first samples, one per row
+        @type  X: C{numpy.ndarray}
+        @param Z: The second samples, one per row
+        @type  Z: C{numpy.ndarray}
+        @return: The kernel matrix, with a row for each sample in X
+        @rtype: C{numpy.ndarray}
+        """
+        gamma = self.gamma if self.gamma is not None else 1.0 / X.shape[1]
+        if self.kernel == 'rbf':
+            return rbf_kernel(X, Z, gamma)
+        return polynomial_kernel(X, Z, gamma, self.degree, self.coef0)
+
+    def _diagonal(self, X):
+        """
+        Compute the kernel between each sample and itself.
+
+        @param X: The samples
+        @type  X: C{numpy.ndarray}
+        @return: The diagonal of the kernel matrix
+        @rtype: C{numpy.ndarray}
+        """
+        if self.kernel == 'rbf':
+            return numpy.ones(len(X))
+        gamma = self.gamma if self.gamma is not None else 1.0 / X.shape[1]
+        return (gamma * (X ** 2).sum(axis=1) + self.coef0) ** self.degree
+
+    def bounds(self, y):
+        """
+        Get the upper bound of each dual variable.
+
+        @param y: The labels
+        @type  y: C{numpy.ndarray}
+        @return: The bounds
+        @rtype: C{numpy.ndarray}
+        """
+        weights = self.class_weight
+        if weights is None:
+            return numpy.repeat(float(self.C), len(y))
+        if weights == 'balanced':
+            positive = (y > 0).sum()
+            weights = {1: len(y) / (2.0 * max(positive, 1)), -1: len(y) / (2.0 * max(len(y) - positive, 1))}
+        return self.C * numpy.where(y > 0, weights.get(1, 1.0), weights.get(-1, 1.0))
+
+    def fit(self, X, y, alpha=None, cache=None):
+        """
+        Train the SVM.
+
+        @param X: The scaled features, one row per sample
+        @type  X: C{numpy.ndarray}
+        @param y: The labels, +1 or -1
+        @type  y: C{numpy.ndarray}
+        @param alpha: Dual variables to start from, such as those of a similar SVM, or None to start from zero
+        @type  alpha: C{numpy.ndarray}
+        @param cache: A cache of kernel rows for X with this kernel, or None to start an empty one
+        @type  cache: L{KernelCache}
+        @return: The SVM
+        @rtype: L{KernelSVM}
+        """
+        if cache is None:
+            cache = KernelCache(X, self.kernel_matrix, self.cache_size)
+        bounds = self.bounds(y)
+        diagonal = self._diagonal(X)
+        # The gradient of the dual objective 1/2 a'Qa - e'a, where Q = yy'K.
+        if alpha is None:
+            alpha = numpy.zeros(len(y))
+            gradient = -numpy.ones(len(y))
+        else:
+            alpha = numpy.clip(alpha, 0, bounds)
+            gradient = -numpy.ones(len(y))
+            for i in numpy.flatnonzero(alpha):
+                gradient += alpha[i] * y[i] * y * cache.row(i)
+        self.iterations = 0
+        while self.iterations < self.max_iter:
+            violation = -y * gradient
+            up = numpy.where(y > 0, alpha < bounds, alpha > 0)
+            low = numpy.where(y > 0, alpha > 0, alpha < bounds)
+            if not up.any() or not low.any():
+                break
+            i = numpy.where(up, violation, -numpy.inf).argmax()
+            if violation[i] - violation[low].min() < self.tol:
+                break
+            K_i = cache.row(i)
+            # Pick the partner that decreases the objective the most.
+            gain = violation[i] - violation
+            curvature = numpy.maximum(diagonal[i] + diagonal - 2 * K_i, 1e-12)
+            candidates = low & (gain > 0)
+            j = numpy.where(candidates, -gain ** 2 / curvature, numpy.inf).argmin()
+            K_j = cache.row(j)
+            self.iterations += 1
+            old_i, old_j = alpha[i], alpha[j]
+            C_i, C_j = bounds[i], bounds[j]
+            Q_ij = y[i] * y[j] * K_i[j]
+            if y[i] != y[j]:
+                delta = (-gradient[i] - gradient[j]) / max(diagonal[i] + diagonal[j] + 2 * Q_ij, 1e-12)
+                diff = alpha[i] - alpha[j]
+                alpha[i] += delta
+                alpha[j] += delta
+                if diff > 0:
+                    if alpha[j] < 0:
+                        alpha[j] = 0
+                        alpha[i] = diff
+                elif alpha[i] < 0:
+                    alpha[i] = 0
+                    alpha[j] = -diff
+                if diff > C_i - C_j:
+                    if alpha[i] > C_i:
+                        alpha[i] = C_i
+                        alpha[j] = C_i - diff
+                elif alpha[j] > C_j:
+                    alpha[j] = C_j
+                    alpha[i] = C_j + diff
+            else:
+                delta = (gradient[i] - gradient[j]) / max(diagonal[i] + diagonal[j] - 2 * Q_ij, 1e-12)
+                total = alpha[i] + alpha[j]
+                alpha[i] -= delta
+                alpha[j] += delta
+                if total > C_i:
+                    if alpha[i] > C_i:
+                        alpha[i] = C_i
+                        alpha[j] = total - C_i
+                elif alpha[j] < 0:
+                    alpha[j] = 0
+                    alpha[i] = total
+                if total > C_j:
+                    if alpha[j] > C_j:
+                        alpha[j] = C_j
+                        alpha[i] = total - C_j
+                elif alpha[i] < 0:
+                    alpha[i] = 0
+                    alpha[j] = total
+            gradient += y * (y[i] * K_i * (alpha[i] - old_i) + y[j] * K_j * (alpha[j] - old_j))
+        self.rho = self._rho(y, alpha, bounds, gradient)
+        support = alpha > 0
+        self.alpha = alpha
+        self.support_vectors = X[support]
+        self.dual_coef = alpha[support] * y[support]
+        self.cache_stats = cache.stats()
+        return self
+
+    def _rho(self, y, alpha, bounds, gradient):
+        """
+        Compute the offset of the decision function from the final gradient.
+
+        @return: The offset
+        @rtype: C{float}
+        """
+        yG = y * gradient
+        free = (alpha > 0) & (alpha < bounds)
+        if free.any():
+            return float(yG[free].mean())
+        # Without free variables the offset lies anywhere in a range; take its middle.
+        upper = numpy.where(alpha >= bounds, y < 0, y > 0)
+        lower = ~upper
+        ub = yG[upper].min() if upper.any() else numpy.inf
+        lb = yG[lower].max() if lower.any() else -numpy.inf
+        if numpy.isinf(ub) or numpy.isinf(lb):
+            return float(ub if numpy.isfinite(ub) else lb if numpy.isfinite(lb) else 0.0)
+        return float((ub + lb) / 2)
+
+    def decision_function(self, X, chunk_size=4096):
+        """
+        Get the signed distance of each sample from the separating surface.
+
+        @param X: The scaled features
+        @type  X: C{numpy.ndarray}
+        @param chunk_size: The number of samples to compute kernels for at once
+        @type  chunk_size: C{int}
+        @return: The decision values
+        @rtype: C{numpy.ndarray}
+        """
+        values = numpy.empty(len(X))
+        for start in range(0, len(X), chunk_size):
+            kernel = self.kernel_matrix(X[start:start + chunk_size], self.support_vectors)
+            values[start:start + chunk_size] = kernel.dot(self.dual_coef) - self.rho
+        return values
+
+
+class Model(object):
+    """
+    A trained classifier together with the scaler for its features.
+    """
+
+    def __init__(self, scaler, classifier):
+        """
+        Combine a scaler and a classifier.
+
+        @param scaler: The fitted scaler
+        @type  scaler: L{Scaler}
+        @param classifier: The trained classifier
+        @type  classifier: L{Classifier}
+        """
+        self.scaler = scaler
+        self.classifier = classifier
+
+    def decision_function(self, X):
+        """
+        Score unscaled features.
+
+        @param X: The features, one row per post
+        @type  X: C{numpy.ndarray}
+        @return: The decision values; positive values predict important posts
+        @rtype: C{numpy.ndarray}
+        """
+        return self.classifier.decision_function(self.scaler.transform(X))
+
+    def save(self, path):
+        """
+        Write the model to a file.
+
+        @param path: The file to write
+        @type  path: C{str}
+        """
+        with open(path, 'wb') as fp:
+            pickle.dump(self, fp, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Read a model written by save.
+
+        @param path: The file to read
+        @type  path: C{str}
+        @return: The model
+        @rtype: L{Model}
+        """
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+
+
+MODEL_PATH = '/var/www/facebook/model'
+"""Where score_posts loads its model from if none is given
+@type: C{str}"""
+
+# Models loaded by score_posts, by path.
+_models = {}
+
+
+def score_posts(user, posts, model=None, window=None):
+    """
+    Predict how important new posts are to a user.
+
+    The posts are scored as one batch: features for all of them are
+    gathered by the user's L{facebook.FeatureEngine}, which reuses the wall
+    indexes, interaction timelines, and common like counts already built
+    for the user, and the model scores the whole feature matrix in one call.
+
+    @param user: The user the posts are being evaluated for
+    @type  user: L{facebook.User}
+    @param posts: The posts, as returned by the Graph API or already converted
+    @type  posts: C{list} of C{dict} or L{facebook.Post}
+    @param model: The model to score with, or None to use the one saved at L{MODEL_PATH}
+    @type  model: L{Model}
+    @param window: How far back, in seconds, to count interactions; use the window the model was trained with
+    @type  window: C{int}
+    @return: The decision value of each post, in order; positive values predict important posts
+    @rtype: C{numpy.ndarray}
+    """
+    if model is None:
+        model = _models.get(MODEL_PATH)
+        if model is None:
+            model = _models[MODEL_PATH] = Model.load(MODEL_PATH)
+    posts = [post if isinstance(post, facebook.Post) else facebook.Post.from_graph(post) for post in posts]
+    if not posts:
+        return numpy.zeros(0)
+    features = numpy.array([row for important, row in user.feature_engine(window).features(posts)], dtype=numpy.float64)
+    return model.decision_function(features)
+
+
+def split(X, y, test_fraction=0.2, seed=0):
+    """
+    Randomly split a dataset into training and test sets.
+
+    @param X: The features
+    @type  X: C{numpy.ndarray}
+    @param y: The labels
+    @type  y: C{numpy.ndarray}
+    @param test_fraction: The fraction of samples to hold out for testing
+    @type  test_fraction: C{float}
+    @param seed: Seed for the random generator
+    @type  seed: C{int}
+    @return: The training features and labels, then the test features and labels
+    @rtype: C{tuple} of C{numpy.ndarray}
+    """
+    order = numpy.random.RandomState(seed).permutation(len(y))
+    n_test = int(len(y) * test_fraction)
+    test, train = order[:n_test], order[n_test:]
+    return X[train], y[train], X[test], y[test]
+
+
+def train(X, y, C=1.0, epochs=20, batch_size=64, test_fraction=0.2, seed=0):
+    """
+    Scale the features, train a linear SVM, and measure it on held out data.
+
+    @param X: The features, one row per post
+    @type  X: C{numpy.ndarray}
+    @param y: The labels, +1 or -1
+    @type  y: C{numpy.ndarray}
+    @param C: The penalty for margin violations
+    @type  C: C{float}
+    @param epochs: The number of passes over the training data
+    @type  epochs: C{int}
+    @param batch_size: The number of samples in each mini-batch
+    @type  batch_size: C{int}
+    @param test_fraction: The fraction of samples to hold out for testing
+    @type  test_fraction: C{float}
+    @param seed: Seed for splitting and training
+    @type  seed: C{int}
+    @return: The model and a report with the training time and accuracies
+    @rtype: C{tuple} of L{Model} and C{dict}
+    """
+    X_train, y_train, X_test, y_test = split(X, y, test_fraction, seed)
+    start = time.time()
+    scaler = Scaler().fit(X_train)
+    X_train = scaler.transform(X_train)
+    svm = LinearSVM(C, epochs, batch_size, seed).fit(X_train, y_train)
+    elapsed = time.time() - start
+    report = {'samples': len(y_train), 'train_time': elapsed, 'train_accuracy': svm.score(X_train, y_train),
+              'test_samples': len(y_test), 'test_accuracy': svm.score(scaler.transform(X_test), y_test)}
+    return Model(scaler, svm), report
+
+
+def train_kernel(X, y, kernel='rbf', C=1.0, gamma=None, cache_size=100, test_fraction=0.2, seed=0, **args):
+    """
+    Scale the features, train a kernel SVM, and measure it on held out data.
+
+    @param X: The features, one row per post
+    @type  X: C{numpy.ndarray}
+    @param y: The labels, +1 or -1
+    @type  y: C{numpy.ndarray}
+    @param kernel: The kernel to use, C{'rbf'} or C{'poly'}
+    @type  kernel: C{str}
+    @param C: The penalty for margin violations
+    @type  C: C{float}
+    @param gamma: The kernel coefficient, or None for one over the number of features
+    @type  gamma: C{float}
+    @param cache_size: The size of the kernel row cache in megabytes
+    @type  cache_size: C{float}
+    @param test_fraction: The fraction of samples to hold out for testing
+    @type  test_fraction: C{float}
+    @param seed: Seed for splitting
+    @type  seed: C{int}
+    @return: The model and a report with the training time, accuracies, and kernel cache counters
+    @rtype: C{tuple} of L{Model} and C{dict}
+    """
+    X_train, y_train, X_test, y_test = split(X, y, test_fraction, seed)
+    start = time.time()
+    scaler = Scaler().fit(X_train)
+    X_train = scaler.transform(X_train)
+    svm = KernelSVM(kernel, C, gamma, cache_size=cache_size, **args).fit(X_train, y_train)
+    elapsed = time.time() - start
+    report = {'samples': len(y_train), 'train_time': elapsed, 'train_accuracy': svm.score(X_train, y_train),
+              'test_samples': len(y_test), 'test_accuracy': svm.score(scaler.transform(X_test), y_test),
+              'iterations': svm.iterations, 'support_vectors': len(svm.dual_coef), 'cache': svm.cache_stats}
+    return Model(scaler, svm), report
+
+
+def grid(Cs=(0.1, 1.0, 10.0, 100.0), gammas=(0.05, 0.2, 1.0), class_weights=(None, 'balanced')):
+    """
+    List every combination of the given hyperparameters.
+
+    @param Cs: The penalties to try
+    @type  Cs: C{list} of C{float}
+    @param gammas: The kernel coefficients to try
+    @type  gammas: C{list} of C{float}
+    @param class_weights: The class weightings to try
+    @type  class_weights: C{list}
+    @return: The combinations
+    @rtype: C{list} of C{dict}
+    """
+    return [{'C': C, 'gamma': gamma, 'class_weight': weight} for C, gamma, weight in itertools.product(Cs, gammas, class_weights)]
+
+
+def random_parameters(n, C_range=(0.01, 1000.0), gamma_range=(0.001, 10.0), class_weights=(None, 'balanced'), seed=0):
+    """
+    Draw hyperparameters at random, with C and gamma uniform on a log scale.
+
+    @param n: The number of combinations to draw
+    @type  n: C{int}
+    @param C_range: The smallest and largest penalty
+    @type  C_range: C{tuple} of C{float}
+    @param gamma_range: The smallest and largest kernel coefficient
+    @type  gamma_range: C{tuple} of C{float}
+    @param class_weights: The class weightings to choose from
+    @type  class_weights: C{list}
+    @param seed: Seed for the random generator
+    @type  seed: C{int}
+    @return: The combinations
+    @rtype: C{list} of C{dict}
+    """
+    rand = numpy.random.RandomState(seed)
+    Cs = numpy.exp(rand.uniform(numpy.log(C_range[0]), numpy.log(C_range[1]), n))
+    gammas = numpy.exp(rand.uniform(numpy.log(gamma_range[0]), numpy.log(gamma_range[1]), n))
+    weights = [class_weights[i] for i in rand.randint(len(class_weights), size=n)]
+    return [{'C': float(C), 'gamma': float(gamma), 'class_weight': weight} for C, gamma, weight in zip(Cs, gammas, weights)]
+
+
+def fold_indices(n, folds, fold, seed=0):
+    """
+    Split sample indices into training and test indices for one fold of cross validation.
+
+    @param n: The number of samples
+    @type  n: C{int}
+    @param folds: The number of folds
+    @type  folds: C{int}
+    @param fold: The fold to get, from 0 to folds - 1
+    @type  fold: C{int}
+    @param seed: Seed for assigning samples to folds
+    @type  seed: C{int}
+    @return: The training indices and the test indices
+    @rtype: C{tuple} of C{numpy.ndarray}
+    """
+    order = numpy.random.RandomState(seed).permutation(n)
+    test = numpy.zeros(n, dtype=bool)
+    test[order[fold::folds]] = True
+    return numpy.flatnonzero(~test), numpy.flatnonzero(test)
+
+
+# Features and labels shared with search worker processes.
+_shared = {}
+
+
+def _share(array):
+    """
+    Copy an array into shared memory that child processes inherit without pickling.
+
+    @param array: The array to share
+    @type  array: C{numpy.ndarray}
+    @return: The shared memory and the shape of the array
+    @rtype: C{tuple}
+    """
+    shared = multiprocessing.sharedctypes.RawArray('d', array.size)
+    numpy.frombuffer(shared, dtype=numpy.float64)[:] = array.ravel()
+    return shared, array.shape
+
+
+def _init_worker(features, labels):
+    """
+    Make the shared features and labels available to a search worker.
+
+    @param features: The shared features and their shape
+    @type  features: C{tuple}
+    @param labels: The shared labels and their shape
+    @type  labels: C{tuple}
+    """
+    for name, (shared, shape) in (('X', features), ('y', labels)):
+        _shared[name] = numpy.frombuffer(shared, dtype=numpy.float64).reshape(shape)
+
+
+def _cross_validate(task):
+    """
+    Train and test SVMs with increasing C on one fold, warm starting each from the last.
+
+    Scaling the dual variables of one SVM by the ratio of the penalties
+    gives a feasible starting point for the next, which is usually close to
+    its solution. The kernel does not depend on C, so the kernel row cache
+    is shared as well.
+
+    @param task: The fold, the number of folds, the seed, the kernel, gamma, the class weighting, the penalties in increasing order, and other KernelSVM arguments
+    @type  task: C{tuple}
+    @return: The kernel coefficient, class weighting, and fold, then the accuracy, balanced accuracy, and SMO steps for each penalty
+    @rtype: C{tuple}
+    """
+    fold, folds, seed, kernel, gamma, class_weight, Cs, args = task
+    X, y = _shared['X'], _shared['y']
+    train, test = fold_indices(len(y), folds, fold, seed)
+    scaler = Scaler().fit(X[train])
+    X_train, y_train = scaler.transform(X[train]), y[train]
+    X_test, y_test = scaler.transform(X[test]), y[test]
+    svm = KernelSVM(kernel, Cs[0], gamma, class_weight=class_weight, **args)
+    cache = KernelCache(X_train, svm.kernel_matrix, svm.cache_size)
+    results = []
+    alpha = None
+    for C in Cs:
+        if alpha is not None:
+            alpha = alpha * (float(C) / svm.C)
+        svm.C = C
+        svm.fit(X_train, y_train, alpha, cache)
+        alpha = svm.alpha
+        predictions = svm.predict(X_test)
+        recalls = [(predictions[y_test == label] == label).mean() for label in (1.0, -1.0) if (y_test == label).any()]
+        results.append((C, float((predictions == y_test).mean()), float(numpy.mean(recalls)), svm.iterations))
+    return (gamma, class_weight, fold), results
+
+
+def search(X, y, parameters, kernel='rbf', folds=5, processes=None, scoring='accuracy', seed=0, **args):
+    """
+    Cross validate kernel SVMs for many hyperparameter combinations in parallel.
+
+    The combinations are grouped by gamma and class weighting, and each
+    group is trained on each fold by one task, in order of increasing C so
+    that every SVM is warm started from the previous one. The tasks run in
+    a process pool. The features and labels are put in shared memory once
+    and inherited by the workers instead of being pickled with every task.
+
+    @param X: The features, one row per post; they are scaled within each fold
+    @type  X: C{numpy.ndarray}
+    @param y: The labels, +1 or -1
+    @type  y: C{numpy.ndarray}
+    @param parameters: The combinations to try, from L{grid} or L{random_parameters}
+    @type  parameters: C{list} of C{dict}
+    @param kernel: The kernel to use, C{'rbf'} or C{'poly'}
+    @type  kernel: C{str}
+    @param folds: The number of cross validation folds
+    @type  folds: C{int}
+    @param processes: The number of worker processes, None for one per CPU, or 1 to run in this process
+    @type  processes: C{int}
+    @param scoring: How to rank combinations, C{'accuracy'} or C{'balanced_accuracy'}
+    @type  scoring: C{str}
+    @param seed: Seed for assigning samples to folds
+    @type  seed: C{int}
+    @return: The mean and standard deviation of each score and the mean SMO steps for every combination, best first
+    @rtype: C{list} of C{dict}
+    """
+    groups = collections.defaultdict(set)
+    for params in parameters:
+        groups[(params['gamma'], params['class_weight'])].add(params['C'])
+    tasks = [(fold, folds, seed, kernel, gamma, class_weight, sorted(Cs), args)
+             for (gamma, class_weight), Cs in sorted(groups.items()) for fold in range(folds)]
+    features, labels = _share(numpy.asarray(X, dtype=numpy.float64)), _share(numpy.asarray(y, dtype=numpy.float64))
+    if processes == 1:
+        _init_worker(features, labels)
+        try:
+            outputs = map(_cross_validate, tasks)
+        finally:
+            _shared.clear()
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (features, labels))
+        try:
+            outputs = pool.map(_cross_validate, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    scores = collections.defaultdict(list)
+    for (gamma, class_weight, fold), results in outputs:
+        for C, accuracy, balanced_accuracy, iterations in results:
+            scores[(C, gamma, class_weight)].append((accuracy, balanced_accuracy, iterations))
+    summary = []
+    for (C, gamma, class_weight), values in scores.iteritems():
+        accuracy, balanced_accuracy, iterations = numpy.array(values).T
+        summary.append({'C': C, 'gamma': gamma, 'class_weight': class_weight,
+                        'accuracy': float(accuracy.mean()), 'accuracy_std': float(accuracy.std()),
+                        'balanced_accuracy': float(balanced_accuracy.mean()),
+                        'balanced_accuracy_std': float(balanced_accuracy.std()), 'iterations': float(iterations.mean())})
+    summary.sort(key=lambda result: result[scoring], reverse=True)
+    return summary
+
+
+def evaluate(model, paths, chunk_size=4096, json=None):
+    """
+    Measure the accuracy of a model on collected files without loading them all.
+
+    @param model: The model to evaluate
+    @type  model: L{Model}
+    @param paths: The files to evaluate on
+    @type  paths: C{list} of C{str}
+    @param chunk_size: The number of posts to score at once
+    @type  chunk_size: C{int}
+    @param json: The JSON parser to use, or None to find one
+    @type  json: C{function}
+    @return: The number of posts and the fraction predicted correctly
+    @rtype: C{tuple} of C{int} and C{float}
+    """
+    total = correct = 0
+    for X, y in iter_chunks(paths, chunk_size, json):
+        total += len(y)
+        correct += int((numpy.where(model.decision_function(X) >= 0, 1.0, -1.0) == y).sum())
+    return total, correct / float(total) if total else 0.0
+
+
+def train_streaming(paths, C=1.0, epochs=5, batch_size=64, chunk_size=4096, test_fraction=0.2, seed=0, json=None):
+    """
+    Train a linear SVM on collected files without loading them all into memory.
+
+    A first pass over the files computes the scaling statistics. Each epoch
+    then reads the files in a new random order and trains on shuffled
+    mini-batches from each chunk. Whole files are held out for testing, so
+    the test accuracy measures how well the model does on users it has not
+    seen.
+
+    @param paths: The files written by tasks.gather_data
+    @type  paths: C{list} of C{str}
+    @param C: The penalty for margin violations
+    @type  C: C{float}
+    @param epochs: The number of passes over the training files
+    @type  epochs: C{int}
+    @param batch_size: The number of samples in each mini-batch
+    @type  batch_size: C{int}
+    @param chunk_size: The number of posts read from disk at once
+    @type  chunk_size: C{int}
+    @param test_fraction: The fraction of files to hold out for testing
+    @type  test_fraction: C{float}
+    @param seed: Seed for choosing test files and for training
+    @type  seed: C{int}
+    @param json: The JSON parser to use, or None to find one
+    @type  json: C{function}
+    @return: The model and a report with the training time and accuracies
+    @rtype: C{tuple} of L{Model} and C{dict}
+    """
+    if json is None:
+        json = facebook.find_json(logging.getLogger('facebook-research'))
+    rand = numpy.random.RandomState(seed)
+    paths = sorted(paths)
+    paths = [paths[i] for i in rand.permutation(len(paths))]
+    n_test = int(len(paths) * test_fraction)
+    test_paths, train_paths = paths[:n_test], paths[n_test:]
+    start = time.time()
+    scaler = Scaler()
+    for X, y in iter_chunks(train_paths, chunk_size, json):
+        scaler.partial_fit(X)
+    svm = LinearSVM(C, epochs, batch_size, seed)
+    for epoch in range(epochs):
+        order = [train_paths[i] for i in rand.permutation(len(train_paths))]
+        for X, y in iter_chunks(order, chunk_size, json):
+            X = scaler.transform(X)
+            rows = rand.permutation(len(y))
+            for offset in range(0, len(rows), batch_size):
+                batch = rows[offset:offset + batch_size]
+                svm.partial_fit(X[batch], y[batch], scaler.count)
+    elapsed = time.time() - start
+    model = Model(scaler, svm)
+    samples, train_accuracy = evaluate(model, train_paths, chunk_size, json)
+    test_samples, test_accuracy = evaluate(model, test_paths, chunk_size, json)
+    report = {'samples': samples, 'train_time': elapsed, 'train_accuracy': train_accuracy,
+              'test_samples': test_samples, 'test_accuracy': test_accuracy}
+    return model, report
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="python svm.py [options] <userdata file>...")
+    parser.add_option('--stream', action='store_true', help="train a linear SVM without loading every file at once")
+    parser.add_option('--kernel', choices=KernelSVM.kernels, help="train a kernel SVM with this kernel")
+    parser.add_option('-C', type='float', default=1.0, help="penalty for margin violations [default: %default]")
+    parser.add_option('--gamma', type='float', help="kernel coefficient [default: 1 / number of features]")
+    parser.add_option('--cache-size', type='float', default=100, help="kernel row cache size in MB [default: %default]")
+    parser.add_option('--class-weight', choices=('balanced',), help="weight labels inversely to their frequency")
+    parser.add_option('--search', type='int', metavar='N', help="cross validate a kernel SVM over a grid of C, gamma, and "
+                      "class weighting, or over N random combinations if N > 0, and show the best")
+    parser.add_option('--folds', type='int', default=5, help="cross validation folds for --search [default: %default]")
+    parser.add_option('--processes', type='int', help="worker processes for --search [default: one per CPU]")
+    parser.add_option('--seed', type='int', default=0, help="random seed [default: %default]")
+    parser.add_option('--save', metavar='PATH', help="save the trained model, e.g. to {0}".format(MODEL_PATH))
+    options, paths = parser.parse_args()
+    if not paths:
+        parser.error("no userdata files given")
+    if options.search is not None:
+        X, y = load_dataset(paths)
+        if options.search > 0:
+            parameters = random_parameters(options.search, seed=options.seed)
+        else:
+            parameters = grid()
+        start = time.time()
+        results = search(X, y, parameters, options.kernel or 'rbf', options.folds, options.processes,
+                         seed=options.seed, cache_size=options.cache_size)
+        print "Cross validated {0} combinations in {1:.3f}s".format(len(results), time.time() - start)
+        for result in results[:10]:
+            print ("C={0[C]:<10.4g} gamma={0[gamma]:<10.4g} class_weight={1:<9} accuracy={0[accuracy]:.3f} (+/-{0[accuracy_std]:.3f}) "
+                   "balanced={0[balanced_accuracy]:.3f} steps={0[iterations]:.0f}").format(result, str(result['class_weight']))
+        sys.exit(0)
+    if options.stream:
+        model, report = train_streaming(paths, options.C, seed=options.seed)
+    elif options.kernel:
+        X, y = load_dataset(paths)
+        model, report = train_kernel(X, y, options.kernel, options.C, options.gamma, options.cache_size, seed=options.seed,
+                                     class_weight=options.class_weight)
+    else:
+        X, y = load_dataset(paths)
+        model, report = train(X, y, options.C, seed=options.seed)
+    print "Trained on {0} posts in {1:.3f}s".format(report['samples'], report['train_time'])
+    if 'cache' in report:
+        print "SMO steps: {0}, support vectors: {1}".format(report['iterations'], report['support_vectors'])
+        print "Kernel cache: {0[hit_rate]:.1%} hit rate, {0[size]} rows, {0[evictions]} evictions".format(report['cache'])
+    print "Training accuracy: {0:.3f}".format(report['train_accuracy'])
+    print "Test accuracy on {0} posts: {1:.3f}".format(report['test_samples'], report['test_accuracy'])
+    if options.save:
+        model.save(options.save)
@@ -59,43 +59,54 @@ def gather_data(access_token):
     
     # Initialize the graph and user.
     logger.debug("Loading Graph API and User objects.")
-    graph = facebook.GraphAPI(logger, json, access_token)
-    user = facebook.User(graph, logger, "me", 2)
+    cache = facebook.ResponseCache('/var/www/facebook/cache')
+    # Every worker process takes its tokens from the same bucket, so concurrent crawls share the app's quota.
+    limiter = facebook.RateLimiter(path='/var/www/facebook/cache/.ratelimit')
+    graph = facebook.GraphAPI(logger, json, access_token, pool_size=8, cache=cache, limiter=limiter)
+    user = facebook.User(graph, logger, "me", 2, batch=True, concurrency=8, lazy=True)
 
-    # See if we have collected user data already.
-    id = user.identity['id']
-    name = user.identity['name']
-    with open('/var/www/facebook/users', 'r+') as fp:
-        for line in fp:
-            data = ','.split(line)
-            if data[0] == id:
-                logger.info('User data already processed.')
-                logger.debug('Uniqid: ' + data[1])
-                return True
-        fp.seek(0, 2)
-        fp.write(str(id) + ':' + str(name) + ',starting,' + str(access_token) + '\n')
+    # Users fetched during this run are only shared within it. Drop them afterwards so a
+    # long-lived worker does not keep their data and connections.
+    try:
+        # See if we have collected user data already. Only the identity has been fetched so far.
+        id = user.identity['id']
+        name = user.identity['name']
+        with open('/var/www/facebook/users', 'r+') as fp:
+            for line in fp:
+                data = line.strip().split(',')
+                if data[0].split(':', 1)[0] == id:
+                    logger.info('User data already processed.')
+                    logger.debug('Uniqid: ' + data[1])
+                    return True
+            fp.seek(0, 2)
+            fp.write(str(id) + ':' + str(name) + ',starting,' + str(access_token) + '\n')
 
 #    gpg = gnupg.GPG(gnupghome=GPG_HOME)
 #    gpgkey = open('parent5446.asc').read()
 
-    # Create the training data
-    logger.info("Beginning creation of training data.")
-    dataset = user.make_training_data()
-    logger.info("Ending creation of training data.")
+        # Create the training data
+        logger.info("Beginning creation of training data.")
+        dataset = user.make_training_data()
+        logger.info("Ending creation of training data.")
+        logger.debug("User registry: {0}".format(facebook.User.registry.stats()))
+        graph.stats.dump(logger)
 
-    # Serialize, encrypt, and store the data
-    logger.info("Training data obtained. Beginning encryption.")
+        # Serialize, encrypt, and store the data
+        logger.info("Training data obtained. Beginning encryption.")
 #    import_result = gpg.import_keys(gpgkey)
 #    ciphertext = gpg.encrypt(pickle.dumps(dataset), import_result)
-    json_dump = facebook.find_json(logger, False)
-    ciphertext = json_dump(dataset)
-    uniqid = uuid.uuid4()
-    logger.debug("Uniqid: " + str(uniqid))
+        json_dump = facebook.find_json(logger, False)
+        ciphertext = json_dump(dataset)
+        uniqid = uuid.uuid4()
+        logger.debug("Uniqid: " + str(uniqid))
     
-    with open('/var/www/facebook/userdata/' + str(uniqid), 'ab') as fp:
-        fp.write(ciphertext)
+        with open('/var/www/facebook/userdata/' + str(uniqid), 'ab') as fp:
+            fp.write(ciphertext)
 
-    # Add user to users file.
-    with open('/var/www/facebook/users', 'a') as fp:
-        fp.write(str(id) + ':' + str(name) + ',ending,' + str(uniqid) + '\n')
-    logger.info("Script complete.")
+        # Add user to users file.
+        with open('/var/www/facebook/users', 'a') as fp:
+            fp.write(str(id) + ':' + str(name) + ',ending,' + str(uniqid) + '\n')
+        logger.info("Script complete.")
+    finally:
+        facebook.User.registry.clear()
+        graph.pool.close()